@@ -0,0 +1,13 @@
+-- Soft delete of users. Tables created before it have no deleted_at column and keep unique constraint on email,
+-- which init_db doesn't change. Email becomes unique only among not deleted users.
+BEGIN;
+
+ALTER TABLE "user" ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP WITH TIME ZONE;
+
+-- New index is created before the old constraint is dropped, so emails are unique all the time
+CREATE UNIQUE INDEX IF NOT EXISTS uq_user_email_not_deleted ON "user" (email) WHERE deleted_at IS NULL;
+ALTER TABLE "user" DROP CONSTRAINT IF EXISTS user_email_key;
+
+CREATE INDEX IF NOT EXISTS ix_user_deleted_at ON "user" (deleted_at) WHERE deleted_at IS NOT NULL;
+
+COMMIT;
@@ -0,0 +1,10 @@
+-- 64 bit user ids. Sharded ids are sequence value times number of slots, so 32 bit ids run out after 33.5M users
+-- per shard. Apply on home database and every shard. Columns are rewritten under exclusive lock, so it takes time
+-- on big tables.
+BEGIN;
+
+ALTER TABLE "user" ALTER COLUMN id TYPE BIGINT;
+ALTER SEQUENCE IF EXISTS user_id_seq AS BIGINT;
+ALTER TABLE IF EXISTS user_event ALTER COLUMN user_id TYPE BIGINT;
+
+COMMIT;
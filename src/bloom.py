@@ -0,0 +1,40 @@
+import hashlib
+import math
+
+
+class BloomFilter:
+    """Probabilistic set of strings. Can say that string is present when it isn't, but never the other way around"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        if capacity <= 0:
+            raise ValueError("Capacity must be positive")
+        if not 0 < error_rate < 1:
+            raise ValueError("Error rate must be between 0 and 1")
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)  # Number of bits
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        """Gets bit positions of item with double hashing over one blake2b digest"""
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def replace_with(self, other: "BloomFilter") -> None:
+        """Replaces content of filter by content of other one, so rebuilt filter can be swapped in place"""
+        self.capacity = other.capacity
+        self.error_rate = other.error_rate
+        self.size = other.size
+        self.hash_count = other.hash_count
+        self._bits = other._bits
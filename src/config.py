@@ -19,14 +19,70 @@ DB_TEST_HOST = os.getenv("DB_TEST_HOST") or "localhost"
 DB_TEST_PORT = os.getenv("DB_TEST_PORT") or "8001"
 
 
-DATABASE_URL = f"{DB_DIALECT}+{DB_DRIVER}://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-TEST_DATABASE_URL = f"{DB_DIALECT}+{DB_DRIVER}://{DB_USER}:{DB_PASSWORD}@{DB_TEST_HOST}:{DB_TEST_PORT}/{DB_NAME}"
+# Full urls override settings above, e.g. DATABASE_URL="sqlite+aiosqlite:///kitty.db" for embedded database.
+DATABASE_URL = (
+    os.getenv("DATABASE_URL")
+    or f"{DB_DIALECT}+{DB_DRIVER}://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+)
+TEST_DATABASE_URL = (
+    os.getenv("TEST_DATABASE_URL")
+    or f"{DB_DIALECT}+{DB_DRIVER}://{DB_USER}:{DB_PASSWORD}@{DB_TEST_HOST}:{DB_TEST_PORT}/{DB_NAME}"
+)
+
+# SQLite settings. Writes of the worker go through one connection one by one, others wait for it in queue.
+SQLITE_WRITE_TIMEOUT_SECONDS = float(os.getenv("SQLITE_WRITE_TIMEOUT_SECONDS") or 30)
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE") or 5)
+
+
+# Sharding settings. If shard urls are set, users are stored on shards and DATABASE_URL keeps only other tables.
+# Users are placed into one of DB_SHARD_SLOTS_COUNT slots by email hash, slots are mapped to shards by
+# DB_SHARD_SLOT_MAP with shard index for every slot. Slots count must never change, only the map.
+DB_SHARD_URLS = [url for url in (os.getenv("DB_SHARD_URLS") or "").split(",") if url]
+DB_SHARD_SLOTS_COUNT = 64
+if os.getenv("DB_SHARD_SLOT_MAP"):
+    DB_SHARD_SLOT_MAP = [int(shard) for shard in os.getenv("DB_SHARD_SLOT_MAP").split(",")]
+else:
+    DB_SHARD_SLOT_MAP = [slot % len(DB_SHARD_URLS) for slot in range(DB_SHARD_SLOTS_COUNT)] if DB_SHARD_URLS else []
+TEST_DB_SHARD_URLS = [url for url in (os.getenv("TEST_DB_SHARD_URLS") or "").split(",") if url]
+
+
+# Purge worker settings. Soft deleted users, old user events and expired tokens are deleted in background by batches.
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE") or 500)
+PURGE_MAX_BATCHES_PER_RUN = int(os.getenv("PURGE_MAX_BATCHES_PER_RUN") or 20)
+PURGE_BATCH_DELAY_SECONDS = float(os.getenv("PURGE_BATCH_DELAY_SECONDS") or 0.5)  # Pause between batches
+PURGE_INTERVAL_SECONDS = float(os.getenv("PURGE_INTERVAL_SECONDS") or 60 * 5)  # Pause between runs
+
+
+# Email filter settings. Filter takes about 1.2 MB per million emails with 1% error rate.
+EMAIL_FILTER_CAPACITY = int(os.getenv("EMAIL_FILTER_CAPACITY") or 1_000_000)
+EMAIL_FILTER_ERROR_RATE = float(os.getenv("EMAIL_FILTER_ERROR_RATE") or 0.01)
+EMAIL_FILTER_REBUILD_INTERVAL_SECONDS = float(os.getenv("EMAIL_FILTER_REBUILD_INTERVAL_SECONDS") or 60 * 60)
+EMAIL_FILTER_REBUILD_CHANNEL = "email_filter_rebuild"  # Rebuild asked by API is sent to every worker
+
+
+# Bulk patch settings. Users found by filter are changed by batches, caller repeats request from the returned id.
+BULK_PATCH_BATCH_SIZE = int(os.getenv("BULK_PATCH_BATCH_SIZE") or 1000)
+
+
+# User change feed settings.
+USER_EVENTS_CHANNEL = "user_events"
+USER_EVENTS_LOCK_KEY = 1_000_001  # Postgres advisory lock, writers of events take it so ids go in commit order
+USER_EVENTS_QUEUE_SIZE = int(os.getenv("USER_EVENTS_QUEUE_SIZE") or 1000)  # Slower stream consumers are dropped
+USER_EVENTS_KEEPALIVE_SECONDS = float(os.getenv("USER_EVENTS_KEEPALIVE_SECONDS") or 15)
+USER_EVENTS_RETENTION_SECONDS = int(os.getenv("USER_EVENTS_RETENTION_SECONDS") or 60 * 60 * 24 * 7)  # 7 days
+
+
+# Token denylist settings. Revoked tokens come to every worker by notification, sync is a safety net for missed ones.
+TOKEN_DENYLIST_CHANNEL = "revoked_tokens"
+TOKEN_DENYLIST_SYNC_SECONDS = float(os.getenv("TOKEN_DENYLIST_SYNC_SECONDS") or 60)
 
 
 # Settings for fastapi-jwt-auth library.
 class AuthJWTSettings(BaseModel):
     authjwt_secret_key: str = os.getenv("AUTHJWT_SECRET_KEY")
     authjwt_access_token_expires: int = 60 * 60 * 12  # 12 hours
+    authjwt_denylist_enabled: bool = True
+    authjwt_denylist_token_checks: set = {"access"}
 
 
 # Crypt settings.
@@ -1,17 +1,110 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
+import sqlalchemy as sa
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
+from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-from . import config
+from . import config, sharding
 
-engine = create_async_engine(
-    config.DATABASE_URL, echo=config.DEBUG
-)
+# Pragmas of every SQLite connection
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # Readers don't block the writer and the other way around
+    "synchronous": "NORMAL",  # Safe with WAL, syncs only on checkpoints
+    "busy_timeout": 5000,  # Waits for writers of other processes instead of failing with database is locked
+    "foreign_keys": "ON",
+    "temp_store": "MEMORY",
+    "cache_size": -20000,  # 20 MB
+    "mmap_size": 256 * 1024 * 1024,
+}
 
-async_session = sessionmaker(bind=engine, expire_on_commit=False, class_=AsyncSession)
+
+def is_sqlite(url: str) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+def set_sqlite_pragmas(sqlite_engine: AsyncEngine) -> None:
+    @sa.event.listens_for(sqlite_engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+
+def get_dialect(session: AsyncSession) -> str:
+    """Gets name of database dialect which session works with. Sharded session can't choose bind without mapper,
+    so dialect of home database is taken, shards always have the same one"""
+    if sharding.is_sharded(session):
+        return session.get_bind(shard_id=sharding.HOME_SHARD).dialect.name
+    return session.get_bind().dialect.name
+
+
+class RoutingSession(Session):
+    """Sends selects to the reader engine and everything else to the writer engine, both are taken from session
+    info. After the first write selects of the transaction go to the writer too, so they see its own changes"""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if isinstance(clause, sa.Select) and not self._flushing and not self.info.get("writing"):
+            return self.info["reader_engine"].sync_engine
+        # ORM bulk inserts ask for bind without clause, so everything except selects is a write
+        self.info["writing"] = True
+        return self.info["writer_engine"].sync_engine
+
+
+@sa.event.listens_for(RoutingSession, "after_transaction_end")
+def _stop_writing(session: RoutingSession, transaction) -> None:
+    if transaction.parent is None:
+        session.info.pop("writing", None)
+
+
+def create_sqlite_engines(url: str) -> tuple[AsyncEngine, AsyncEngine]:
+    """Creates writer and reader engines of SQLite database file. SQLite has only one writer at a time, so writes
+    of the worker go through the only connection of writer engine, waiting for it in pool is the queue of writes"""
+    # Dialect uses NullPool for files by default, pooled connections keep their pragmas and page cache
+    writer_engine = create_async_engine(
+        url, echo=config.DEBUG, poolclass=AsyncAdaptedQueuePool,
+        pool_size=1, max_overflow=0, pool_timeout=config.SQLITE_WRITE_TIMEOUT_SECONDS
+    )
+    reader_engine = create_async_engine(
+        url, echo=config.DEBUG, poolclass=AsyncAdaptedQueuePool, pool_size=config.SQLITE_READ_POOL_SIZE
+    )
+    set_sqlite_pragmas(writer_engine)
+    set_sqlite_pragmas(reader_engine)
+    return writer_engine, reader_engine
+
+
+def routing_sessionmaker(writer_engine: AsyncEngine, reader_engine: AsyncEngine) -> sessionmaker:
+    return sessionmaker(
+        expire_on_commit=False,
+        class_=AsyncSession,
+        sync_session_class=RoutingSession,
+        info={"writer_engine": writer_engine, "reader_engine": reader_engine},
+    )
+
+
+if is_sqlite(config.DATABASE_URL):
+    engine, reader_engine = create_sqlite_engines(config.DATABASE_URL)
+else:
+    engine = create_async_engine(
+        config.DATABASE_URL, echo=config.DEBUG
+    )
+    reader_engine = engine
+
+# Engines of user shards, empty if sharding is off
+shard_engines = [create_async_engine(url, echo=config.DEBUG) for url in config.DB_SHARD_URLS]
+
+if shard_engines:
+    sharding.validate_slot_map(config.DB_SHARD_SLOT_MAP, len(shard_engines))
+    async_session = sharding.sharded_sessionmaker(engine, shard_engines)
+elif is_sqlite(config.DATABASE_URL):
+    async_session = routing_sessionmaker(engine, reader_engine)
+else:
+    async_session = sessionmaker(bind=engine, expire_on_commit=False, class_=AsyncSession)
 
 Base = declarative_base()
 
 
 async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    for db_engine in (engine, *shard_engines):
+        async with db_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
@@ -0,0 +1,35 @@
+import time
+
+
+class TokenDenylist:
+    """In-memory set of revoked token ids of the worker. Checks are plain dict lookups, ids are kept until
+    their tokens expire, so the set holds only tokens that could still be accepted"""
+
+    def __init__(self):
+        self._tokens: dict[str, float] = {}  # Token id -> expiration timestamp
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self._tokens
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def add(self, jti: str, expires_at: float) -> None:
+        if expires_at > time.time():
+            self._tokens[jti] = expires_at
+
+    def prune(self) -> int:
+        """Forgets ids of expired tokens, returns number of forgotten ids"""
+        now = time.time()
+        expired = [jti for jti, expires_at in self._tokens.items() if expires_at <= now]
+        for jti in expired:
+            del self._tokens[jti]
+        return len(expired)
+
+    def on_notification(self, connection, pid: int, channel: str, payload: str) -> None:
+        """Adds token revoked by another worker, payload is token id and expiration timestamp split by space"""
+        jti, expires_at = payload.split(" ")
+        self.add(jti, float(expires_at))
+
+
+denylist = TokenDenylist()
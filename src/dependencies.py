@@ -5,7 +5,7 @@ from fastapi_jwt_auth.exceptions import AuthJWTException
 from sqlalchemy.ext.asyncio import AsyncSession
 from . import database
 from .exceptions import CredentialsError, InactiveUserError
-from .models import User
+from .models import UserRow
 from .schemas import TokenSubject
 from .services import UserService
 
@@ -21,7 +21,7 @@ async def get_current_user(
         authorize: AuthJWT = Depends(),
         session: AsyncSession = Depends(get_async_session),
         token=Depends(oauth2_scheme)  # Using this dependency for swagger ui
-) -> User:
+) -> UserRow:
     """Dependency that returns user from JWT token in request header, make routes protected in swagger ui"""
     try:
         authorize.jwt_required()
@@ -30,14 +30,14 @@ async def get_current_user(
     except AuthJWTException:
         raise CredentialsError()
 
-    user = await UserService(session).get_user(email=email)
+    user = await UserService(session).get_user_row(email=email)
     if user is None:
         raise CredentialsError()
 
     return user
 
 
-async def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
+async def get_current_active_user(current_user: UserRow = Depends(get_current_user)) -> UserRow:
     """Checks if user is active"""
     if not current_user.is_active:
         raise InactiveUserError()
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from . import config, database, notifications
+from .models import UserEvent
+from .schemas import UserEventSchemaOut
+from .services import UserService
+
+logger = logging.getLogger(__name__)
+
+REPLAY_BATCH_SIZE = 1000
+
+
+class UserEventBroadcaster:
+    """Listens to user events on one database connection per worker and fans them out to all subscribed streams.
+    Other listeners can be added on the same connection with add_channel_listener"""
+
+    def __init__(self, channel: str, queue_size: int):
+        self.channel = channel
+        self.queue_size = queue_size
+        self._queues: set[asyncio.Queue] = set()
+        self._connection: Optional[AsyncConnection] = None
+        self._channel_listeners: list[tuple[str, Callable]] = [(channel, self._on_notification)]
+        self._reconnect_listeners: list[Callable[[], Awaitable]] = []
+
+    def add_channel_listener(self, channel: str, callback: Callable) -> None:
+        """Adds asyncpg notification callback, must be called before start"""
+        self._channel_listeners.append((channel, callback))
+
+    def add_reconnect_listener(self, callback: Callable[[], Awaitable]) -> None:
+        """Adds coroutine function called after lost connection is restored, notifications sent while it was lost
+        are missed, so listeners can reload their state"""
+        self._reconnect_listeners.append(callback)
+
+    async def start(self) -> None:
+        if database.engine.dialect.name != "postgresql":  # Without LISTEN only events of this worker are sent
+            for channel, callback in self._channel_listeners:
+                notifications.add_local_listener(channel, callback)
+            return
+
+        self._connection = await database.engine.connect()
+        raw_connection = await self._connection.get_raw_connection()
+        driver_connection = raw_connection.driver_connection
+        for channel, callback in self._channel_listeners:
+            await driver_connection.add_listener(channel, callback)
+        driver_connection.add_termination_listener(self._on_termination)
+
+    async def stop(self) -> None:
+        if database.engine.dialect.name != "postgresql":
+            for channel, callback in self._channel_listeners:
+                notifications.remove_local_listener(channel, callback)
+
+        if self._connection is not None:
+            raw_connection = await self._connection.get_raw_connection()
+            driver_connection = raw_connection.driver_connection
+            driver_connection.remove_termination_listener(self._on_termination)
+            for channel, callback in self._channel_listeners:
+                await driver_connection.remove_listener(channel, callback)
+            await self._connection.close()
+            self._connection = None
+        self._disconnect_all()
+
+    def subscribe(self) -> asyncio.Queue:
+        """Returns queue with payloads of new events. None in queue means that stream must be closed,
+        consumer can reconnect and resume from the last received event id"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._queues.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._queues.discard(queue)
+
+    def _on_notification(self, connection, pid: int, channel: str, payload: str) -> None:
+        for queue in list(self._queues):
+            if queue.full():  # Consumer is too slow, drop it instead of buffering without limit
+                self.unsubscribe(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+            else:
+                queue.put_nowait(payload)
+
+    def _on_termination(self, connection) -> None:
+        logger.warning("User events listener connection is lost, reconnecting")
+        self._connection = None
+        self._disconnect_all()
+        asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        while self._connection is None:
+            try:
+                await self.start()
+            except Exception:
+                logger.exception("Failed to reconnect user events listener")
+                await asyncio.sleep(1)
+        for callback in self._reconnect_listeners:
+            try:
+                await callback()
+            except Exception:
+                logger.exception("Failed to run reconnect listener %s", callback.__name__)
+
+    def _disconnect_all(self) -> None:
+        for queue in list(self._queues):
+            self.unsubscribe(queue)
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+
+broadcaster = UserEventBroadcaster(config.USER_EVENTS_CHANNEL, config.USER_EVENTS_QUEUE_SIZE)
+
+
+def format_server_sent_event(event_id: int, payload: str) -> str:
+    return f"id: {event_id}\ndata: {payload}\n\n"
+
+
+async def replay_user_events(session: AsyncSession, after: int) -> AsyncIterator[UserEvent]:
+    """Yields logged user events after given event id by batches"""
+    while True:
+        events = await UserService(session).get_user_events(after=after, limit=REPLAY_BATCH_SIZE)
+        for event in events:
+            yield event
+        if len(events) < REPLAY_BATCH_SIZE:
+            return
+        after = events[-1].id
+
+
+async def stream_user_events(session: AsyncSession, after: int, follow: bool) -> AsyncIterator[str]:
+    """Yields server-sent events with user changes after given event id. Logged events are replayed from database,
+    then new ones come from broadcaster if follow is True"""
+    async for event in replay_user_events(session, after):
+        yield format_server_sent_event(event.id, UserEventSchemaOut.from_orm(event).json())
+        after = event.id
+    await session.commit()  # Releases connection, next replay sees events committed meanwhile
+    if not follow:
+        return
+
+    # Events committed before subscription are only in database, so they are replayed once more after it. Events
+    # committed after subscription can be both replayed and received, ids of all replayed ones are skipped in queue
+    queue = broadcaster.subscribe()
+    try:
+        replayed_ids = set()
+        async for event in replay_user_events(session, after):
+            yield format_server_sent_event(event.id, UserEventSchemaOut.from_orm(event).json())
+            replayed_ids.add(event.id)
+        await session.commit()
+
+        while True:
+            try:
+                payload = await asyncio.wait_for(queue.get(), timeout=config.USER_EVENTS_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if payload is None:
+                return
+            event_id = json.loads(payload)["id"]
+            if event_id in replayed_ids:
+                continue
+            yield format_server_sent_event(event_id, payload)
+    finally:
+        broadcaster.unsubscribe(queue)
@@ -49,4 +49,12 @@ class UserNotFoundError(HTTPException):
         super().__init__(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"User with id {user_id} is not found"
-        )
\ No newline at end of file
+        )
+
+
+class InvalidTokenError(HTTPException):
+    def __init__(self) -> None:
+        super().__init__(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Token is invalid or expired"
+        )
@@ -1,21 +1,25 @@
+import asyncio
 from typing import Literal
 
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, Query, Header
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi_jwt_auth import AuthJWT
 from fastapi_jwt_auth.exceptions import AuthJWTException
+from pydantic import EmailStr
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse
 
-from . import config, database
+from . import config, database, events, workers
+from .denylist import denylist
 from .dependencies import get_async_session, get_current_active_user
 from .exceptions import IncorrectEmailOrPasswordError, UserNotFoundError, NotSuperUserError, EmailAlreadyExistsError, \
-    CredentialsError
-from .models import User
-from .schemas import UserSchemaOut, UserSchemaRegistration, UserSchemaLogin, UserSchemaPatch
-from .services import UserService
+    CredentialsError, InvalidTokenError
+from .models import User, UserRow
+from .schemas import UserSchemaOut, UserSchemaRegistration, UserSchemaLogin, UserSchemaPatch, UserSchemaBulkPatch, \
+    UserSchemaBulkPatchOut, TokenSchemaRevoke, EmailAvailabilitySchemaOut
+from .services import UserService, TokenService, on_user_event_notification
 
 
 app = FastAPI()
@@ -26,11 +30,59 @@ async def init_models():
     await database.init_db()
 
 
+@app.on_event("startup")
+async def start_user_events_listener():
+    """Starts listening before email filter and denylist are loaded, so changes made meanwhile aren't missed"""
+    events.broadcaster.add_channel_listener(config.USER_EVENTS_CHANNEL, on_user_event_notification)
+    events.broadcaster.add_channel_listener(config.TOKEN_DENYLIST_CHANNEL, denylist.on_notification)
+    events.broadcaster.add_channel_listener(
+        config.EMAIL_FILTER_REBUILD_CHANNEL, workers.on_email_filter_rebuild_notification
+    )
+    events.broadcaster.add_reconnect_listener(build_email_filter)  # Emails created while disconnected were missed
+    await events.broadcaster.start()
+
+
+@app.on_event("startup")
+async def build_email_filter():
+    async with database.async_session() as session:
+        await UserService(session).rebuild_email_filter()
+
+
+@app.on_event("startup")
+async def load_token_denylist():
+    app.state.denylist_synced_until = await workers.sync_token_denylist()
+
+
+@app.on_event("shutdown")
+async def stop_user_events_listener():
+    await events.broadcaster.stop()
+
+
+@app.on_event("startup")
+async def start_workers():
+    app.state.workers = [
+        asyncio.create_task(workers.run_purge_worker()),
+        asyncio.create_task(workers.run_email_filter_rebuild_worker()),
+        asyncio.create_task(workers.run_token_denylist_sync_worker(app.state.denylist_synced_until)),
+    ]
+
+
+@app.on_event("shutdown")
+async def stop_workers():
+    for worker in app.state.workers:
+        worker.cancel()
+
+
 @AuthJWT.load_config
 def get_config():
     return config.AuthJWTSettings()
 
 
+@AuthJWT.token_in_denylist_loader
+def check_if_token_in_denylist(decrypted_token: dict) -> bool:
+    return decrypted_token["jti"] in denylist
+
+
 @app.exception_handler(AuthJWTException)
 def authjwt_exception_handler(request: Request, exc: AuthJWTException):
     return JSONResponse(
@@ -53,18 +105,95 @@ async def login(
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+@app.post('/logout/')
+async def logout(
+        authorize: AuthJWT = Depends(),
+        current_user: UserRow = Depends(get_current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+) -> dict[Literal["message"], Literal["success"]]:
+    """Route to revoke access token from request header"""
+    raw_token = authorize.get_raw_jwt()
+    await TokenService(session).revoke_token(jti=raw_token["jti"], expires_at=raw_token["exp"])
+    return {"message": "success"}
+
+
+@app.post('/tokens/revoke/')
+async def revoke_token(
+        token_data: TokenSchemaRevoke,
+        authorize: AuthJWT = Depends(),
+        current_user: UserRow = Depends(get_current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+) -> dict[Literal["message"], Literal["success"]]:
+    """Route to revoke any own access token, superusers can revoke tokens of other users"""
+    try:
+        raw_token = authorize.get_raw_jwt(token_data.token)
+    except AuthJWTException:
+        raise InvalidTokenError()
+
+    if raw_token["sub"] != current_user.email and not current_user.is_superuser:
+        raise NotSuperUserError()
+
+    await TokenService(session).revoke_token(jti=raw_token["jti"], expires_at=raw_token["exp"])
+    return {"message": "success"}
+
+
 @app.get('/users/me/', response_model=UserSchemaOut)
-async def get_current_user(current_user: User = Depends(get_current_active_user)) -> User:
+async def get_current_user(current_user: UserRow = Depends(get_current_active_user)) -> UserRow:
     """Route to get current user by JWT token in header"""
     return current_user
 
 
+@app.get('/users/email-available/', response_model=EmailAvailabilitySchemaOut)
+async def check_email_available(
+        email: EmailStr = Query(),
+        session: AsyncSession = Depends(get_async_session)
+) -> dict[Literal["email", "available"], str | bool]:
+    """Route to check if email is not taken yet, mostly answers without database"""
+    available = await UserService(session).is_email_available(email)
+    return {"email": email, "available": available}
+
+
+@app.post('/users/email-available/rebuild/', status_code=status.HTTP_202_ACCEPTED)
+async def rebuild_email_filter(
+        current_user: UserRow = Depends(get_current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+) -> dict[Literal["message"], Literal["success"]]:
+    """Route to rebuild email filters of all workers from database, only for superusers. Rebuild is sent to workers
+    by notification and runs in background, so response comes before it's finished"""
+    if not current_user.is_superuser:
+        raise NotSuperUserError()
+
+    await UserService(session).request_email_filter_rebuild()
+    return {"message": "success"}
+
+
+@app.get('/users/events/')
+async def stream_user_events(
+        after: int = Query(default=0, ge=0),
+        follow: bool = True,
+        last_event_id: int | None = Header(default=None, ge=0),
+        current_user: UserRow = Depends(get_current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+) -> StreamingResponse:
+    """Route to stream user changes as server-sent events, only for superusers.
+    Resumes after Last-Event-ID header or after query param, closes when all logged events are sent if not follow"""
+    if not current_user.is_superuser:
+        raise NotSuperUserError()
+
+    cursor = last_event_id if last_event_id is not None else after
+    return StreamingResponse(
+        events.stream_user_events(session, after=cursor, follow=follow),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
 @app.get('/users/{user_id}/', response_model=UserSchemaOut)
 async def get_certain_user(
         user_id: int,
-        current_user: User = Depends(get_current_active_user),
+        current_user: UserRow = Depends(get_current_active_user),
         session: AsyncSession = Depends(get_async_session),
-) -> User:
+) -> UserRow:
     """Route to get certain user, even if users are different"""
     if user_id == current_user.id:  # check not to re-pull the current user
         return current_user
@@ -72,19 +201,33 @@ async def get_certain_user(
     if not current_user.is_superuser:
         raise NotSuperUserError()
 
-    user = await UserService(session).get_user(id=user_id)
+    user = await UserService(session).get_user_row(id=user_id)
     if user is None:
         raise UserNotFoundError(user_id)
     return user
 
 
+@app.get('/users/', response_model=list[UserSchemaOut])
+async def list_users(
+        after: int = Query(default=0, ge=0),
+        limit: int = Query(default=100, ge=1, le=1000),
+        current_user: UserRow = Depends(get_current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+) -> list[UserRow]:
+    """Route to get page of users ordered by id, next page starts after the last id, only for superusers"""
+    if not current_user.is_superuser:
+        raise NotSuperUserError()
+
+    return await UserService(session).list_users(after_id=after, limit=limit)
+
+
 @app.post('/users/', status_code=status.HTTP_201_CREATED, response_model=UserSchemaOut)
 async def create_new_user(
         user_data: UserSchemaRegistration,
         session: AsyncSession = Depends(get_async_session),
 ) -> User:
     """Route to create new user"""
-    user_with_entered_email = await UserService(session).get_user(email=user_data.email)
+    user_with_entered_email = await UserService(session).get_user_row(email=user_data.email)
     if user_with_entered_email is not None:
         raise EmailAlreadyExistsError(user_data.email)
 
@@ -96,31 +239,53 @@ async def create_new_user(
 async def patch_user(
         user_id: int,
         user_data: UserSchemaPatch,
-        current_user: User = Depends(get_current_active_user),
+        current_user: UserRow = Depends(get_current_active_user),
         session: AsyncSession = Depends(get_async_session)
-) -> User:
+) -> UserRow:
     """Route to partially change user"""
-    if user_id == current_user.id:  # check not to re-pull the current user
-        updated_user = await UserService(session).patch_user(stored_user=current_user, user_data=user_data)
-        return updated_user
+    if user_id != current_user.id and not current_user.is_superuser:
+        raise NotSuperUserError()
+
+    updated_user = await UserService(session).patch_user(id=user_id, user_data=user_data)
+    if updated_user is None:
+        raise UserNotFoundError(user_id)
+    return updated_user
 
+
+@app.patch('/users/', response_model=UserSchemaBulkPatchOut)
+async def bulk_patch_users(
+        bulk_data: UserSchemaBulkPatch,
+        current_user: UserRow = Depends(get_current_active_user),
+        session: AsyncSession = Depends(get_async_session)
+) -> dict[Literal["updated_ids", "missing_ids", "next_after_id"], list[int] | int | None]:
+    """Route to change many users by ids or filter at once, only for superusers. Users found by filter are changed
+    by one batch per request, while next_after_id is returned, request must be repeated with it as after_id"""
     if not current_user.is_superuser:
         raise NotSuperUserError()
 
-    stored_user = await UserService(session).get_user(id=user_id)
-    if stored_user is None:
-        raise UserNotFoundError(user_id)
+    if bulk_data.ids is not None:
+        updated_ids = await UserService(session).bulk_patch_users(user_data=bulk_data.data, ids=bulk_data.ids)
+        missing_ids = sorted(set(bulk_data.ids) - set(updated_ids))
+        return {"updated_ids": sorted(updated_ids), "missing_ids": missing_ids, "next_after_id": None}
 
-    updated_user = await UserService(session).patch_user(stored_user=stored_user, user_data=user_data)
-    return updated_user
+    batch_size = config.BULK_PATCH_BATCH_SIZE
+    ids = await UserService(session).find_user_ids(bulk_data.filter, after_id=bulk_data.after_id, limit=batch_size)
+    updated_ids = []
+    if ids:
+        updated_ids = await UserService(session).bulk_patch_users(
+            user_data=bulk_data.data, ids=ids, filter=bulk_data.filter
+        )
+    next_after_id = ids[-1] if len(ids) == batch_size else None
+    return {"updated_ids": sorted(updated_ids), "missing_ids": [], "next_after_id": next_after_id}
 
 
 @app.delete('/users/{user_id}/')
 async def delete_user(
         user_id: int,
-        current_user: User = Depends(get_current_user),
+        current_user: UserRow = Depends(get_current_user),
         session: AsyncSession = Depends(get_async_session)
 ) -> dict[Literal["message"], Literal["success"]]:
+    """Route to delete user, user is soft deleted and purged from database later in background"""
     if user_id == current_user.id:
         await UserService(session).delete_user(id=user_id)
         return {"message": "success"}
@@ -128,7 +293,7 @@ async def delete_user(
     if not current_user.is_superuser:
         raise NotSuperUserError()
 
-    user = await UserService(session).get_user(id=user_id)
+    user = await UserService(session).get_user_row(id=user_id)
     if user is None:
         raise UserNotFoundError(user_id)
 
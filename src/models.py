@@ -1,16 +1,89 @@
+import datetime
+from typing import NamedTuple
+
 from sqlalchemy import func
-from . import database
+from sqlalchemy.orm import deferred
+from . import database, sharding
 import sqlalchemy as sa
 
+# Source of user ids on shards, see sharding.new_user_id
+user_local_id_seq = sa.Sequence(sharding.USER_LOCAL_ID_SEQUENCE, metadata=database.Base.metadata)
+
+# Type of 64 bit ids, SQLite autoincrements only primary keys of INTEGER type, which is 64 bit there anyway
+BigId = sa.BigInteger().with_variant(sa.Integer, "sqlite")
+
+
+class UTCDateTime(sa.TypeDecorator):
+    """Timezone aware datetime on every database. SQLite has no time zones, so time is stored there in UTC without
+    zone and gets UTC zone back when it's loaded"""
+    impl = sa.DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value: datetime.datetime | None, dialect) -> datetime.datetime | None:
+        if value is not None and value.tzinfo is not None and dialect.name == "sqlite":
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value: datetime.datetime | None, dialect) -> datetime.datetime | None:
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value
+
 
 class User(database.Base):
     __tablename__ = "user"
 
-    id = sa.Column(sa.Integer, primary_key=True)
-    email = sa.Column(sa.String(255), unique=True, nullable=False)
+    id = sa.Column(BigId, primary_key=True)  # Sharded ids are sequence value times number of slots, see new_user_id
+    email = sa.Column(sa.String(255), nullable=False)
     profile_picture_id = sa.Column(sa.String(255), nullable=False)
     profile_picture_url = sa.Column(sa.String(255), nullable=False)
-    hashed_password = sa.Column(sa.String(255), nullable=False)
+    hashed_password = deferred(sa.Column(sa.String(255), nullable=False))  # Loaded only on authentication
     is_active = sa.Column(sa.Boolean, default=True, nullable=False)
     is_superuser = sa.Column(sa.Boolean, default=False, nullable=False)
-    created_at = sa.Column(sa.DateTime(timezone=True), server_default=func.now(), nullable=False)
+    created_at = sa.Column(UTCDateTime, server_default=func.now(), nullable=False)
+    deleted_at = sa.Column(UTCDateTime, nullable=True)  # Tombstone, row is purged in background
+
+    __table_args__ = (
+        # Email is unique only among not deleted users, so it can be registered again right after deletion
+        sa.Index(
+            "uq_user_email_not_deleted", email, unique=True,
+            postgresql_where=deleted_at.is_(None), sqlite_where=deleted_at.is_(None)
+        ),
+        sa.Index(
+            "ix_user_deleted_at", deleted_at,
+            postgresql_where=deleted_at.is_not(None), sqlite_where=deleted_at.is_not(None)
+        ),
+    )
+
+
+class UserEvent(database.Base):
+    """Log of user changes, lets change feed consumers resume from the last seen event id"""
+    __tablename__ = "user_event"
+
+    id = sa.Column(BigId, primary_key=True)
+    user_id = sa.Column(BigId, nullable=False)  # Without foreign key, events outlive purged users
+    action = sa.Column(sa.String(16), nullable=False)
+    data = sa.Column(sa.JSON, nullable=False)
+    created_at = sa.Column(UTCDateTime, server_default=func.now(), nullable=False, index=True)
+
+
+class RevokedToken(database.Base):
+    __tablename__ = "revoked_token"
+
+    jti = sa.Column(sa.String(64), primary_key=True)
+    expires_at = sa.Column(UTCDateTime, nullable=False, index=True)
+    revoked_at = sa.Column(UTCDateTime, server_default=func.now(), nullable=False, index=True)
+
+
+class UserRow(NamedTuple):
+    """Lightweight immutable projection of user without password hash, used on hot read paths instead of ORM object"""
+    id: int
+    email: str
+    profile_picture_id: str
+    profile_picture_url: str
+    is_active: bool
+    is_superuser: bool
+    created_at: datetime.datetime
+
+
+USER_ROW_COLUMNS = tuple(getattr(User, field) for field in UserRow._fields)
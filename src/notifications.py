@@ -0,0 +1,42 @@
+from typing import Callable
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import database
+
+# Listeners of notifications sent by the current worker, used when database has no notifications of its own
+local_listeners: dict[str, list[Callable]] = {}
+
+
+def add_local_listener(channel: str, callback: Callable) -> None:
+    """Adds callback with the same arguments as asyncpg notification callback"""
+    local_listeners.setdefault(channel, []).append(callback)
+
+
+def remove_local_listener(channel: str, callback: Callable) -> None:
+    local_listeners.get(channel, []).remove(callback)
+
+
+async def notify(session: AsyncSession, channel: str, payloads: list[str]) -> None:
+    """Sends notifications which are delivered only after commit. Postgres delivers them to listeners of all
+    workers, other databases have no notifications, so they are delivered only to local listeners"""
+    if database.get_dialect(session) == "postgresql":
+        payload = sa.func.unnest(sa.bindparam("payloads", payloads, type_=ARRAY(sa.Text))).column_valued("payload")
+        await session.execute(sa.select(sa.func.pg_notify(channel, payload)))
+    else:
+        session.info.setdefault("notifications", []).extend((channel, payload) for payload in payloads)
+
+
+@sa.event.listens_for(Session, "after_commit")
+def _deliver_local_notifications(session: Session) -> None:
+    for channel, payload in session.info.pop("notifications", []):
+        for callback in local_listeners.get(channel, []):
+            callback(None, 0, channel, payload)
+
+
+@sa.event.listens_for(Session, "after_rollback")
+def _drop_local_notifications(session: Session) -> None:
+    session.info.pop("notifications", None)
@@ -0,0 +1,128 @@
+"""Moves user slots between shards.
+
+Resharding goes in three steps:
+1. Add new shard urls to the end of DB_SHARD_URLS, keeping the current map in DB_SHARD_SLOT_MAP, because default
+   map depends on number of shards. Then copy moved slots to their new shards:
+   python -m src.reshard copy --shards-count 4
+   or with explicit map of shard index for every slot:
+   python -m src.reshard copy --slot-map 0,1,2,3,...
+   Writes to moved slots must be stopped until the next step.
+2. Deploy the new map printed by copy command in DB_SHARD_SLOT_MAP.
+3. Delete rows which don't belong to their shards anymore:
+   python -m src.reshard cleanup
+"""
+import argparse
+import asyncio
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from . import config, database, sharding
+from .models import User
+
+BATCH_SIZE = 1000
+
+user_table = User.__table__
+
+
+def slot_is(slot: int) -> sa.ColumnElement:
+    return user_table.c.id % config.DB_SHARD_SLOTS_COUNT == slot
+
+
+async def get_sequence_value(engine: AsyncEngine) -> int:
+    async with engine.connect() as conn:
+        result = await conn.execute(sa.text(f"SELECT last_value FROM {sharding.USER_LOCAL_ID_SEQUENCE}"))
+        return result.scalar_one()
+
+
+async def copy_slot(slot: int, source: AsyncEngine, target: AsyncEngine) -> int:
+    """Copies users of slot by batches keeping their ids, returns number of copied users"""
+    copied = 0
+    last_id = -1
+    while True:
+        async with source.connect() as conn:
+            query = (
+                sa.select(user_table)
+                .where(slot_is(slot), user_table.c.id > last_id)
+                .order_by(user_table.c.id)
+                .limit(BATCH_SIZE)
+            )
+            rows = (await conn.execute(query)).mappings().all()
+        if not rows:
+            break
+        async with target.begin() as conn:
+            await conn.execute(insert(user_table).on_conflict_do_nothing(index_elements=["id"]), rows)
+        copied += len(rows)
+        last_id = rows[-1]["id"]
+
+    # Ids of moved slot were taken from source sequence, target must not give them again
+    source_value = await get_sequence_value(source)
+    sequence = sharding.USER_LOCAL_ID_SEQUENCE
+    async with target.begin() as conn:
+        await conn.execute(
+            sa.text(f"SELECT setval('{sequence}', GREATEST(last_value, :source_value)) FROM {sequence}"),
+            {"source_value": source_value}
+        )
+    return copied
+
+
+async def delete_slot(slot: int, engine: AsyncEngine) -> int:
+    """Deletes users of slot by batches, returns number of deleted users"""
+    deleted = 0
+    while True:
+        async with engine.begin() as conn:
+            batch = sa.select(user_table.c.id).where(slot_is(slot)).limit(BATCH_SIZE)
+            result = await conn.execute(sa.delete(user_table).where(user_table.c.id.in_(batch.scalar_subquery())))
+        if not result.rowcount:
+            break
+        deleted += result.rowcount
+    return deleted
+
+
+async def copy(target_map: list[int]) -> None:
+    sharding.validate_slot_map(target_map, len(database.shard_engines))
+    await database.init_db()  # Creates tables on new shards
+    for slot, (source_shard, target_shard) in enumerate(zip(config.DB_SHARD_SLOT_MAP, target_map)):
+        if source_shard == target_shard:
+            continue
+        copied = await copy_slot(slot, database.shard_engines[source_shard], database.shard_engines[target_shard])
+        print(f"Slot {slot}: copied {copied} users from shard {source_shard} to shard {target_shard}")
+    print(f"Deploy new slot map and run cleanup: DB_SHARD_SLOT_MAP={','.join(map(str, target_map))}")
+
+
+async def cleanup() -> None:
+    for shard, engine in enumerate(database.shard_engines):
+        for slot, slot_shard in enumerate(config.DB_SHARD_SLOT_MAP):
+            if slot_shard == shard:
+                continue
+            deleted = await delete_slot(slot, engine)
+            if deleted:
+                print(f"Slot {slot}: deleted {deleted} users from shard {shard}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    copy_parser = subparsers.add_parser("copy", help="copy moved slots to their new shards")
+    target = copy_parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--shards-count", type=int, help="spread slots evenly over first shards")
+    target.add_argument("--slot-map", help="comma separated shard index for every slot")
+    subparsers.add_parser("cleanup", help="delete users from shards which don't own their slots")
+    args = parser.parse_args()
+
+    if not database.shard_engines:
+        parser.error("Sharding is off, set DB_SHARD_URLS")
+
+    if args.command == "copy":
+        if args.slot_map:
+            target_map = [int(shard) for shard in args.slot_map.split(",")]
+        else:
+            target_map = [slot % args.shards_count for slot in range(config.DB_SHARD_SLOTS_COUNT)]
+        asyncio.run(copy(target_map))
+    else:
+        asyncio.run(cleanup())
+
+
+if __name__ == "__main__":
+    main()
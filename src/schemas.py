@@ -1,7 +1,7 @@
 import datetime
 from typing import Optional
 
-from pydantic import EmailStr, constr, BaseModel, validator
+from pydantic import EmailStr, constr, conint, conlist, BaseModel, validator, root_validator
 
 from . import utils
 
@@ -35,17 +35,55 @@ class UserSchemaPatch(BaseModel):
     password: Optional[constr(min_length=6, max_length=24)]
     is_active: Optional[bool]
 
+    @root_validator(skip_on_failure=True)
+    def not_empty(cls, values):
+        if all(value is None for value in values.values()):
+            raise ValueError("At least one field must be filled")
+        return values
+
     def replace_password_to_hash(self) -> dict:
         """Transforms into a dictionary with hashed_password attribute instead of plain password"""
-        user_data: dict = self.dict(exclude_unset=True)
+        user_data: dict = self.dict(exclude_unset=True, exclude_none=True)
         if not user_data:
             raise ValueError("No data for update")
-        hashed_password = utils.get_password_hash(self.password)
-        del user_data["password"]
-        user_data.update({"hashed_password": hashed_password})
+        if "password" in user_data:
+            hashed_password = utils.get_password_hash(user_data.pop("password"))
+            user_data.update({"hashed_password": hashed_password})
         return user_data
 
 
+class UserSchemaFilter(BaseModel):
+    email_domain: Optional[constr(min_length=1, max_length=255)]
+    is_active: Optional[bool]
+    created_after: Optional[datetime.datetime]
+    created_before: Optional[datetime.datetime]
+
+    @root_validator(skip_on_failure=True)
+    def not_empty(cls, values):
+        if all(value is None for value in values.values()):
+            raise ValueError("At least one filter must be filled")
+        return values
+
+
+class UserSchemaBulkPatch(BaseModel):
+    ids: Optional[conlist(int, min_items=1, max_items=10000, unique_items=True)]
+    filter: Optional[UserSchemaFilter]
+    after_id: conint(ge=0) = 0  # Users found by filter are changed by batches in order of ids
+    data: UserSchemaPatch
+
+    @root_validator(skip_on_failure=True)
+    def ids_or_filter(cls, values):
+        if (values.get("ids") is None) == (values.get("filter") is None):
+            raise ValueError("Exactly one of ids or filter must be filled")
+        return values
+
+
+class UserSchemaBulkPatchOut(BaseModel):
+    updated_ids: list[int]
+    missing_ids: list[int]
+    next_after_id: Optional[int]  # Set when filter matched more users, request must be repeated with it as after_id
+
+
 class UserSchemaOut(BaseModel):
     id: int
     email: str
@@ -58,5 +96,25 @@ class UserSchemaOut(BaseModel):
         orm_mode = True
 
 
+class EmailAvailabilitySchemaOut(BaseModel):
+    email: str
+    available: bool
+
+
+class UserEventSchemaOut(BaseModel):
+    id: int
+    user_id: int
+    action: str
+    data: dict
+    created_at: datetime.datetime
+
+    class Config:
+        orm_mode = True
+
+
 class TokenSubject(BaseModel):
     email: EmailStr
+
+
+class TokenSchemaRevoke(BaseModel):
+    token: constr(min_length=1)
@@ -1,44 +1,164 @@
+import datetime
+import json
 import logging
 from typing import Optional
 
 import sqlalchemy as sa
 from pydantic import EmailStr
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.models import User
-from src.schemas import UserSchemaRegistration, UserSchemaPatch
-from . import utils
+from src.models import User, UserEvent, UserRow, USER_ROW_COLUMNS, RevokedToken
+from src.schemas import UserSchemaRegistration, UserSchemaPatch, UserSchemaFilter, UserSchemaOut, \
+    UserEventSchemaOut
+from . import config, database, notifications, sharding, utils
+from .bloom import BloomFilter
+from .denylist import denylist
 from .utils import get_random_kitty_picture_id
 
+logger = logging.getLogger(__name__)
+
+# Emails of all users, filled on startup. Deleted emails can't be removed from it, they stay until next rebuild
+email_filter = BloomFilter(config.EMAIL_FILTER_CAPACITY, config.EMAIL_FILTER_ERROR_RATE)
+EMAIL_FILTER_PAGE_SIZE = 10000
+# Filters which are being built, emails created meanwhile go to them too, so they aren't lost on swap
+rebuilt_email_filters: list[BloomFilter] = []
+
+
+def add_to_email_filter(email: str) -> None:
+    email_filter.add(email)
+    for new_filter in rebuilt_email_filters:
+        new_filter.add(email)
+
+
+def on_user_event_notification(connection, pid: int, channel: str, payload: str) -> None:
+    """Adds emails of users created by any worker to email filter, so it never says that taken email is free"""
+    event = json.loads(payload)
+    if event["action"] == "create":
+        add_to_email_filter(event["data"]["email"])
+
 
 class UserService:
     """Class for getting or changing user data in database"""
 
     def __init__(self, session: AsyncSession):
         self.session = session
+        self._events_session: Optional[AsyncSession] = None  # Home database session with events of sharded changes
 
-    async def get_user(self, id: Optional[int] = None, email: Optional[EmailStr] = None) -> User | None:
-        """Gets user by id or email. At least one argument must be filled"""
+    async def _publish_events(self, action: str, events: dict[int, dict]) -> None:
+        """Logs user events by user id and sends them to change feed listeners, they are delivered only after commit
+        made by _commit"""
+        if not events:
+            return
+
+        if sharding.is_sharded(self.session):
+            if self._events_session is None:
+                self._events_session = sharding.home_session(self.session)
+            await self._insert_events(self._events_session, action, events)
+        else:
+            await self._insert_events(self.session, action, events)
+
+    async def _commit(self) -> None:
+        """Commits user changes with their events. With sharding users and events are in different databases, which
+        can't be committed atomically. Events are committed and sent after changes, so anyone who gets an event can
+        read the change, but if events commit fails, the change stays without event"""
+        events_session, self._events_session = self._events_session, None
+        if events_session is None:
+            await self.session.commit()
+            return
+
+        async with events_session:  # Closing rolls events back if changes weren't committed
+            await self.session.commit()
+            try:
+                await events_session.commit()
+            except Exception:
+                logger.exception("Events of committed user changes are lost")
+                raise
+
+    @staticmethod
+    async def _insert_events(session: AsyncSession, action: str, events: dict[int, dict]) -> None:
+        """Inserts events under lock held until commit, so they are committed in order of their ids and change feed
+        consumers resuming after the last seen id never skip an event committed later with smaller id. SQLite has
+        only one writer at a time and needs no lock"""
+        if database.get_dialect(session) == "postgresql":
+            await session.execute(sa.select(sa.func.pg_advisory_xact_lock(config.USER_EVENTS_LOCK_KEY)))
+        query = sa.insert(UserEvent).returning(UserEvent)
+        result = await session.execute(
+            query, [{"user_id": user_id, "action": action, "data": data} for user_id, data in events.items()]
+        )
+        payloads = [UserEventSchemaOut.from_orm(event).json() for event in result.scalars()]
+        await notifications.notify(session, config.USER_EVENTS_CHANNEL, payloads)
+
+    async def get_user_events(self, after: int, limit: int) -> list[UserEvent]:
+        """Gets logged user events with id greater than after, ordered by id"""
+        query = sa.select(UserEvent).where(UserEvent.id > after).order_by(UserEvent.id).limit(limit)
+        result = await self.session.execute(query)
+        return list(result.scalars())
+
+    async def purge_user_events(self, older_than: datetime.datetime, batch_size: int) -> int:
+        """Deletes one batch of logged user events created before older_than, returns number of deleted rows"""
+        batch = (
+            sa.select(UserEvent.id)
+            .where(UserEvent.created_at < older_than)
+            .order_by(UserEvent.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        query = sa.delete(UserEvent).where(UserEvent.id.in_(batch.scalar_subquery())).returning(UserEvent.id)
+        result = await self.session.execute(query)
+        deleted_ids = result.scalars().all()
+        await self.session.commit()
+        return len(deleted_ids)
+
+    @staticmethod
+    def _filter_user(query: sa.Select, id: Optional[int] = None, email: Optional[EmailStr] = None) -> sa.Select:
+        """Filters query by id or email among not deleted users. At least one argument must be filled"""
         if id is None and email is None:
             raise ValueError("At least one argument must be filled")
 
-        query = sa.select(User)
+        query = query.where(User.deleted_at.is_(None))
         if id is not None:
             query = query.where(User.id == id)
         if email is not None:
             query = query.where(User.email == email)
+        return query
 
+    async def get_user(self, id: Optional[int] = None, email: Optional[EmailStr] = None) -> User | None:
+        """Gets user by id or email. At least one argument must be filled"""
+        query = self._filter_user(sa.select(User), id=id, email=email)
         result = await self.session.execute(query)
         user = result.scalar_one_or_none()
         return user
 
-    async def authenticate_user(self, email: EmailStr, password: str) -> User | None:
+    async def get_user_row(self, id: Optional[int] = None, email: Optional[EmailStr] = None) -> UserRow | None:
+        """Gets user by id or email as a lightweight row, selects only UserRow columns and skips identity map"""
+        query = self._filter_user(sa.select(*USER_ROW_COLUMNS), id=id, email=email)
+        result = await self.session.execute(query)
+        row = result.one_or_none()
+        return UserRow(*row) if row is not None else None
+
+    async def list_users(self, after_id: int = 0, limit: int = 100) -> list[UserRow]:
+        """Gets page of users ordered by id, starting after given id. With sharding every shard returns its page
+        and pages are merged here"""
+        query = (
+            sa.select(*USER_ROW_COLUMNS)
+            .where(User.deleted_at.is_(None), User.id > after_id)
+            .order_by(User.id)
+            .limit(limit)
+        )
+        result = await self.session.execute(query)
+        return sorted(UserRow(*row) for row in result)[:limit]
+
+    async def authenticate_user(self, email: EmailStr, password: str) -> UserRow | None:
         """Checks if user's data matches the entered data, returns user if successful"""
-        user = await self.get_user(email=email)
-        if user is None:
+        query = self._filter_user(sa.select(*USER_ROW_COLUMNS, User.hashed_password), email=email)
+        result = await self.session.execute(query)
+        row = result.one_or_none()
+        if row is None:
             return
-        if utils.verify_password(password, user.hashed_password):
-            return user
+        *user, hashed_password = row
+        if utils.verify_password(password, hashed_password):
+            return UserRow(*user)
 
     async def create_user(self, user_data: UserSchemaRegistration) -> User:
         """Creates new user, gets profile picture from api"""
@@ -48,25 +168,214 @@ class UserService:
             "profile_picture_id": profile_picture_id,
             "profile_picture_url": f"https://catass.com/cat/{profile_picture_id}?width=200&height=200"
         })
+        if database.shard_engines:
+            new_user["id"] = sharding.new_user_id(new_user["email"])
         new_user = User(**new_user)
         self.session.add(new_user)
-        await self.session.commit()
+        await self.session.flush()
+        user_event_data = UserSchemaOut.from_orm(new_user).dict(exclude={"id", "created_at"})
+        await self._publish_events("create", {new_user.id: user_event_data})
+        await self._commit()
+        add_to_email_filter(new_user.email)  # Notification comes a bit later
 
         return new_user
 
-    async def patch_user(self, stored_user: User, user_data: UserSchemaPatch) -> User | None:
-        """Partially changes user data"""
-        user_data: dict = user_data.replace_password_to_hash()
-        updated_user = await utils.update_sql_entity(stored_user, user_data)
+    async def is_email_available(self, email: EmailStr) -> bool:
+        """Checks if email is not taken, goes to database only if email filter can't answer for sure"""
+        if email not in email_filter:
+            return True
+        query = self._filter_user(sa.select(User.id), email=email)
+        result = await self.session.execute(query)
+        return result.first() is None
+
+    async def rebuild_email_filter(self) -> int:
+        """Builds new email filter from all not deleted users and swaps it in place, returns number of emails"""
+        new_filter = BloomFilter(config.EMAIL_FILTER_CAPACITY, config.EMAIL_FILTER_ERROR_RATE)
+        emails_count = 0
+        last_id = 0
+        rebuilt_email_filters.append(new_filter)
+        try:
+            while True:  # Pages by id instead of one streamed query, so it works the same way on shards
+                query = (
+                    sa.select(User.id, User.email)
+                    .where(User.deleted_at.is_(None), User.id > last_id)
+                    .order_by(User.id)
+                    .limit(EMAIL_FILTER_PAGE_SIZE)
+                )
+                result = await self.session.execute(query)
+                rows = sorted(result.all())[:EMAIL_FILTER_PAGE_SIZE]
+                if not rows:
+                    break
+                for _, email in rows:
+                    new_filter.add(email)
+                emails_count += len(rows)
+                last_id = rows[-1].id
+        finally:
+            rebuilt_email_filters.remove(new_filter)
+        email_filter.replace_with(new_filter)
+        return emails_count
+
+    async def request_email_filter_rebuild(self) -> None:
+        """Asks every worker, the current one included, to rebuild its email filter in background"""
+        await notifications.notify(self.session, config.EMAIL_FILTER_REBUILD_CHANNEL, [""])
         await self.session.commit()
 
-        return updated_user
+    async def patch_user(self, id: int, user_data: UserSchemaPatch) -> UserRow | None:
+        """Partially changes user data, returns updated user or None if user is not found"""
+        user_data: dict = user_data.replace_password_to_hash()
+        query = (
+            sa.update(User)
+            .where(User.id == id, User.deleted_at.is_(None))
+            .values(**user_data)
+            .returning(*USER_ROW_COLUMNS)
+        )
+        result = await self.session.execute(query)
+        row = result.one_or_none()
+        if row is not None:
+            await self._publish_events("update", {row.id: self._public_changes(user_data)})
+        await self._commit()
+
+        return UserRow(*row) if row is not None else None
+
+    @staticmethod
+    def _public_changes(user_data: dict) -> dict:
+        """Leaves only changes that can be sent to change feed, password hash is never sent"""
+        return {key: value for key, value in user_data.items() if key != "hashed_password"}
 
-    async def delete_user(self, user: User):
-        """Deletes user"""
-        await self.session.delete(user)
+    @staticmethod
+    def _filter_users(query: sa.Select | sa.Update, filter: UserSchemaFilter) -> sa.Select | sa.Update:
+        if filter.email_domain is not None:
+            query = query.where(User.email.endswith(f"@{filter.email_domain}", autoescape=True))
+        if filter.is_active is not None:
+            query = query.where(User.is_active == filter.is_active)
+        if filter.created_after is not None:
+            query = query.where(User.created_at >= filter.created_after)
+        if filter.created_before is not None:
+            query = query.where(User.created_at < filter.created_before)
+        return query
+
+    async def find_user_ids(self, filter: UserSchemaFilter, after_id: int = 0, limit: int = 100) -> list[int]:
+        """Gets ids of not deleted users matching filter with id greater than after_id, ordered by id"""
+        query = (
+            self._filter_users(sa.select(User.id), filter)
+            .where(User.deleted_at.is_(None), User.id > after_id)
+            .order_by(User.id)
+            .limit(limit)
+        )
+        result = await self.session.execute(query)
+        return sorted(result.scalars())[:limit]  # Shards return a page each
+
+    async def bulk_patch_users(
+            self,
+            user_data: UserSchemaPatch,
+            ids: list[int],
+            filter: Optional[UserSchemaFilter] = None
+    ) -> list[int]:
+        """Changes many users by ids in one statement, returns ids of updated users. Filter is checked again,
+        so users found by find_user_ids aren't changed if they stopped matching it meanwhile"""
+        user_data: dict = user_data.replace_password_to_hash()  # Password is hashed once for all users
+        query = sa.update(User).where(User.deleted_at.is_(None))
+        if database.get_dialect(self.session) == "postgresql":
+            ids_param = sa.bindparam("ids", ids, type_=postgresql.ARRAY(sa.BigInteger))
+            query = query.where(User.id == sa.any_(ids_param))  # One parameter for any number of ids
+        else:
+            query = query.where(User.id.in_(ids))
+        if filter is not None:
+            query = self._filter_users(query, filter)
+
+        query = (
+            query.values(**user_data)
+            .returning(User.id)
+            .execution_options(synchronize_session=False)
+        )
+        result = await self.session.execute(query)
+        updated_ids = list(result.scalars())
+        changes = self._public_changes(user_data)
+        await self._publish_events("update", {user_id: changes for user_id in updated_ids})
+        await self._commit()
+
+        return updated_ids
+
+    async def delete_user(self, id: int) -> None:
+        """Soft deletes user by setting a tombstone, the row itself is removed later by purge_deleted_users"""
+        query = (
+            sa.update(User)
+            .where(User.id == id, User.deleted_at.is_(None))
+            .values(deleted_at=sa.func.now())
+            .returning(User.id)
+            .execution_options(synchronize_session=False)
+        )
+        result = await self.session.execute(query)
+        await self._publish_events("delete", {user_id: {} for user_id in result.scalars()})
+        await self._commit()
+
+    async def purge_deleted_users(self, batch_size: int) -> int:
+        """Hard deletes one batch of soft deleted users, returns number of deleted rows"""
+        batch = (
+            sa.select(User.id)
+            .where(User.deleted_at.is_not(None))
+            .order_by(User.deleted_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)  # Don't wait for rows locked by someone else
+        )
+        query = (
+            sa.delete(User)
+            .where(User.id.in_(batch.scalar_subquery()))
+            .returning(User.id)  # Row count isn't available when results of several shards are merged
+            .execution_options(synchronize_session=False)
+        )
+        result = await self.session.execute(query)
+        deleted_ids = result.scalars().all()
         await self.session.commit()
+        return len(deleted_ids)
 
 
+class TokenService:
+    """Class for revoking JWT tokens"""
 
+    def __init__(self, session: AsyncSession):
+        self.session = session
 
+    async def revoke_token(self, jti: str, expires_at: int) -> None:
+        """Saves token id to database and sends it to denylists of all workers, they get it only after commit"""
+        insert = postgresql.insert if database.get_dialect(self.session) == "postgresql" else sqlite.insert
+        query = (
+            insert(RevokedToken)
+            .values(jti=jti, expires_at=datetime.datetime.fromtimestamp(expires_at, tz=datetime.timezone.utc))
+            .on_conflict_do_nothing()
+        )
+        await self.session.execute(query)
+        await notifications.notify(self.session, config.TOKEN_DENYLIST_CHANNEL, [f"{jti} {expires_at}"])
+        await self.session.commit()
+        denylist.add(jti, expires_at)  # Current worker doesn't wait for notification
+
+    async def get_revoked_tokens(self, revoked_after: Optional[datetime.datetime] = None) -> list[sa.Row]:
+        """Gets not expired revoked tokens, only revoked after given time if it's filled"""
+        query = (
+            sa.select(RevokedToken.jti, RevokedToken.expires_at, RevokedToken.revoked_at)
+            .where(RevokedToken.expires_at > sa.func.now())
+        )
+        if revoked_after is not None:
+            query = query.where(RevokedToken.revoked_at > revoked_after)
+        result = await self.session.execute(query)
+        return list(result)
+
+    async def purge_expired_tokens(self, batch_size: int) -> int:
+        """Deletes one batch of expired revoked tokens, they are rejected by expiration anyway.
+        Returns number of deleted rows"""
+        batch = (
+            sa.select(RevokedToken.jti)
+            .where(RevokedToken.expires_at <= sa.func.now())
+            .order_by(RevokedToken.expires_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        query = (
+            sa.delete(RevokedToken)
+            .where(RevokedToken.jti.in_(batch.scalar_subquery()))
+            .returning(RevokedToken.jti)
+        )
+        result = await self.session.execute(query)
+        deleted_jtis = result.scalars().all()
+        await self.session.commit()
+        return len(deleted_jtis)
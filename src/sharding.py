@@ -0,0 +1,125 @@
+import hashlib
+from typing import Optional
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import ORMExecuteState, Mapper, sessionmaker
+from sqlalchemy.sql import operators, visitors
+
+from . import config
+
+HOME_SHARD = "home"  # Database from DATABASE_URL, keeps every table except users
+USER_TABLE = "user"
+USER_LOCAL_ID_SEQUENCE = "user_local_id_seq"
+
+
+def validate_slot_map(slot_map: list[int], shards_count: int) -> None:
+    if len(slot_map) != config.DB_SHARD_SLOTS_COUNT:
+        raise ValueError(f"Slot map must have {config.DB_SHARD_SLOTS_COUNT} items, got {len(slot_map)}")
+    if any(not 0 <= shard < shards_count for shard in slot_map):
+        raise ValueError(f"Slot map must have shard indexes from 0 to {shards_count - 1}")
+
+
+def sharded_sessionmaker(home_engine: AsyncEngine, shard_engines: list[AsyncEngine]) -> sessionmaker:
+    """Creates factory of sessions that route statements to home database or user shards"""
+    shards = {HOME_SHARD: home_engine, **{str(shard): engine for shard, engine in enumerate(shard_engines)}}
+    return sessionmaker(
+        expire_on_commit=False,
+        class_=AsyncSession,
+        sync_session_class=ShardedSession,
+        # Shards are used inside sync session, so sync engines are passed
+        shards={shard: engine.sync_engine for shard, engine in shards.items()},
+        shard_chooser=shard_chooser,
+        identity_chooser=identity_chooser,
+        execute_chooser=execute_chooser,
+        info={"home_engine": home_engine},
+    )
+
+
+def is_sharded(session: AsyncSession) -> bool:
+    return isinstance(session.sync_session, ShardedSession)
+
+
+def home_session(session: AsyncSession) -> AsyncSession:
+    """Creates separate session of home database of sharded session, its transaction is committed on its own"""
+    return AsyncSession(bind=session.info["home_engine"], expire_on_commit=False)
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def slot_for_email(email: str) -> int:
+    """Gets slot by stable hash of normalized email, unlike built-in hash it's the same in every process"""
+    digest = hashlib.blake2b(normalize_email(email).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % config.DB_SHARD_SLOTS_COUNT
+
+
+def slot_for_id(id: int) -> int:
+    """Gets slot encoded in user id, see new_user_id"""
+    return id % config.DB_SHARD_SLOTS_COUNT
+
+
+def shard_for_slot(slot: int, slot_map: Optional[list[int]] = None) -> str:
+    slot_map = slot_map if slot_map is not None else config.DB_SHARD_SLOT_MAP
+    return str(slot_map[slot])
+
+
+def user_shards() -> list[str]:
+    return [str(shard) for shard in range(len(config.DB_SHARD_URLS))]
+
+
+def new_user_id(email: str) -> sa.ColumnElement:
+    """SQL expression of id for new user. Ids are built from shard local sequence and email slot, so id points
+    to its shard without lookups and stays the same when slot is moved to another shard"""
+    return sa.func.nextval(USER_LOCAL_ID_SEQUENCE) * config.DB_SHARD_SLOTS_COUNT + slot_for_email(email)
+
+
+def shard_chooser(mapper: Mapper, instance, clause=None) -> str:
+    """Chooses shard for new ORM object"""
+    if mapper.local_table.name != USER_TABLE:
+        return HOME_SHARD
+    return shard_for_slot(slot_for_email(instance.email))
+
+
+def identity_chooser(mapper: Mapper, primary_key: tuple, **kwargs) -> list[str]:
+    """Chooses shards for getting ORM object by primary key"""
+    if mapper.local_table.name != USER_TABLE:
+        return [HOME_SHARD]
+    return [shard_for_slot(slot_for_id(primary_key[0]))]
+
+
+def execute_chooser(context: ORMExecuteState) -> list[str]:
+    """Chooses shards for statement. Statements about users go to one shard if they are filtered by id or email
+    equality, to all shards otherwise. Results of several shards are concatenated"""
+    mapper = context.bind_mapper
+    if mapper is None or mapper.local_table.name != USER_TABLE:
+        return [HOME_SHARD]
+    if context.is_insert:
+        raise ValueError("Users must be added with session.add, so shard is chosen by email")
+
+    shards = _find_user_shards(context.statement.whereclause)
+    return sorted(shards) if shards else user_shards()
+
+
+def _find_user_shards(whereclause: Optional[sa.ColumnElement]) -> set[str]:
+    """Finds shards of comparisons with user id or email in where clause of statement"""
+    shards = set()
+    if whereclause is None:
+        return shards
+
+    def visit_binary(binary):
+        if binary.operator is not operators.eq or not isinstance(binary.right, sa.BindParameter):
+            return
+        column = binary.left
+        if not isinstance(column, sa.Column) or column.table.name != USER_TABLE:
+            return
+        value = binary.right.effective_value
+        if column.name == "id":
+            shards.add(shard_for_slot(slot_for_id(value)))
+        elif column.name == "email":
+            shards.add(shard_for_slot(slot_for_email(value)))
+
+    visitors.traverse(whereclause, {}, {"binary": visit_binary})
+    return shards
@@ -0,0 +1,124 @@
+import asyncio
+import datetime
+import logging
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import config, database
+from .denylist import denylist
+from .services import UserService, TokenService
+
+logger = logging.getLogger(__name__)
+
+
+async def purge_by_batches(purge_batch: Callable[[AsyncSession], Awaitable[int]]) -> int:
+    """Runs purge of one batch in new session until a short batch with a pause between them, so tables aren't
+    locked for long, returns number of deleted rows. Stops after PURGE_MAX_BATCHES_PER_RUN batches, the rest is
+    purged on the next run"""
+    purged = 0
+    for _ in range(config.PURGE_MAX_BATCHES_PER_RUN):
+        async with database.async_session() as session:
+            deleted = await purge_batch(session)
+        purged += deleted
+        if deleted < config.PURGE_BATCH_SIZE:
+            break
+        await asyncio.sleep(config.PURGE_BATCH_DELAY_SECONDS)
+    return purged
+
+
+async def purge_deleted_users() -> int:
+    """Hard deletes soft deleted users, returns number of deleted rows"""
+    return await purge_by_batches(
+        lambda session: UserService(session).purge_deleted_users(batch_size=config.PURGE_BATCH_SIZE)
+    )
+
+
+async def purge_user_events() -> int:
+    """Deletes user events older than USER_EVENTS_RETENTION_SECONDS, returns number of deleted rows"""
+    older_than = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+        seconds=config.USER_EVENTS_RETENTION_SECONDS
+    )
+    return await purge_by_batches(
+        lambda session: UserService(session).purge_user_events(
+            older_than=older_than, batch_size=config.PURGE_BATCH_SIZE
+        )
+    )
+
+
+async def purge_expired_tokens() -> int:
+    """Deletes expired revoked tokens, returns number of deleted rows"""
+    return await purge_by_batches(
+        lambda session: TokenService(session).purge_expired_tokens(batch_size=config.PURGE_BATCH_SIZE)
+    )
+
+
+async def run_purge_worker() -> None:
+    """Endless loop that purges soft deleted users, old user events and expired revoked tokens
+    every PURGE_INTERVAL_SECONDS"""
+    jobs = {
+        "deleted users": purge_deleted_users,
+        "old user events": purge_user_events,
+        "expired revoked tokens": purge_expired_tokens,
+    }
+    while True:
+        for name, purge in jobs.items():
+            try:
+                purged = await purge()
+                if purged:
+                    logger.info("Purged %s %s", purged, name)
+            except Exception:
+                logger.exception("Failed to purge %s", name)
+        await asyncio.sleep(config.PURGE_INTERVAL_SECONDS)
+
+
+# Rebuilds asked by notifications, tasks are referenced until they are done, so they aren't garbage collected
+email_filter_rebuild_tasks: set[asyncio.Task] = set()
+
+
+async def rebuild_email_filter() -> None:
+    try:
+        async with database.async_session() as session:
+            await UserService(session).rebuild_email_filter()
+    except Exception:
+        logger.exception("Failed to rebuild email filter")
+
+
+def on_email_filter_rebuild_notification(connection, pid: int, channel: str, payload: str) -> None:
+    """Rebuilds email filter of this worker in background when any worker is asked to rebuild it"""
+    task = asyncio.create_task(rebuild_email_filter())
+    email_filter_rebuild_tasks.add(task)
+    task.add_done_callback(email_filter_rebuild_tasks.discard)
+
+
+async def run_email_filter_rebuild_worker() -> None:
+    """Endless loop that rebuilds email filter every EMAIL_FILTER_REBUILD_INTERVAL_SECONDS.
+    Drops emails of deleted users, users created by other workers come with user event notifications"""
+    while True:
+        await asyncio.sleep(config.EMAIL_FILTER_REBUILD_INTERVAL_SECONDS)
+        await rebuild_email_filter()
+
+
+async def sync_token_denylist(revoked_after: Optional[datetime.datetime] = None) -> Optional[datetime.datetime]:
+    """Adds tokens revoked after given time to denylist and forgets expired ones, loads all if time isn't filled.
+    Returns time of the latest revoked token or None if there are no tokens"""
+    async with database.async_session() as session:
+        tokens = await TokenService(session).get_revoked_tokens(revoked_after=revoked_after)
+    for token in tokens:
+        denylist.add(token.jti, token.expires_at.timestamp())
+    denylist.prune()
+    return max((token.revoked_at for token in tokens), default=None)
+
+
+async def run_token_denylist_sync_worker(revoked_after: Optional[datetime.datetime]) -> None:
+    """Endless loop that syncs denylist every TOKEN_DENYLIST_SYNC_SECONDS. Each sync overlaps the previous one,
+    because revoked_at is the start time of transaction which could commit later"""
+    overlap = datetime.timedelta(seconds=config.TOKEN_DENYLIST_SYNC_SECONDS)
+    while True:
+        await asyncio.sleep(config.TOKEN_DENYLIST_SYNC_SECONDS)
+        try:
+            latest = await sync_token_denylist(revoked_after - overlap if revoked_after is not None else None)
+            if latest is not None and (revoked_after is None or latest > revoked_after):
+                revoked_after = latest
+        except Exception:
+            logger.exception("Failed to sync token denylist")
@@ -109,6 +109,20 @@ async def auth_headers_superuser(superuser_encoded_jwt_token: str) -> tuple[Lite
     return auth_headers
 
 
+@pytest_asyncio.fixture(scope="function")
+async def admin_encoded_jwt_token(seed_db) -> str:
+    user_email = PAYLOAD_DATA["user_1"]["email"]  # The only user with is_superuser
+    encoded_token = AuthJWT().create_access_token(subject=user_email, algorithm="HS256",
+                                                  expires_time=60 * 60 * 3)
+    return encoded_token
+
+
+@pytest_asyncio.fixture(scope="function")
+async def auth_headers_admin(admin_encoded_jwt_token: str) -> tuple[Literal["Authorization"], str]:
+    auth_headers = ('Authorization', f'Bearer {admin_encoded_jwt_token}')
+    return auth_headers
+
+
 @pytest_asyncio.fixture(scope="function")
 async def ordinary_user_encoded_jwt_token(seed_db) -> str:
     user_email = "test@example.com"
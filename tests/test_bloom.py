@@ -0,0 +1,34 @@
+import pytest
+
+from src.bloom import BloomFilter
+
+
+def test_bloom_filter():
+    bloom_filter = BloomFilter(capacity=1000, error_rate=0.01)
+    emails = [f"user{i}@example.com" for i in range(1000)]
+    for email in emails:
+        bloom_filter.add(email)
+
+    assert all(email in bloom_filter for email in emails)
+    false_positives = sum(f"other{i}@example.com" in bloom_filter for i in range(10000))
+    assert false_positives < 10000 * 0.02
+
+
+def test_bloom_filter_replace_with():
+    bloom_filter = BloomFilter(capacity=10, error_rate=0.01)
+    bloom_filter.add("old@example.com")
+
+    new_filter = BloomFilter(capacity=100, error_rate=0.001)
+    new_filter.add("new@example.com")
+    bloom_filter.replace_with(new_filter)
+
+    assert "new@example.com" in bloom_filter
+    assert "old@example.com" not in bloom_filter
+    assert bloom_filter.size == new_filter.size
+
+
+def test_bloom_filter_wrong_data():
+    with pytest.raises(ValueError):
+        BloomFilter(capacity=0, error_rate=0.01)
+    with pytest.raises(ValueError):
+        BloomFilter(capacity=10, error_rate=1)
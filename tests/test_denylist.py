@@ -0,0 +1,31 @@
+import time
+
+from src.denylist import TokenDenylist
+
+
+def test_token_denylist():
+    denylist = TokenDenylist()
+    denylist.add("revoked", time.time() + 60)
+    denylist.add("expired", time.time() - 60)  # Expired tokens are rejected anyway, no need to keep them
+
+    assert "revoked" in denylist
+    assert "expired" not in denylist
+    assert "other" not in denylist
+    assert len(denylist) == 1
+
+
+def test_token_denylist_prune():
+    denylist = TokenDenylist()
+    denylist.add("revoked", time.time() + 60)
+    denylist.add("expiring", time.time() + 0.01)
+    time.sleep(0.02)
+
+    assert denylist.prune() == 1
+    assert "revoked" in denylist
+    assert "expiring" not in denylist
+
+
+def test_token_denylist_on_notification():
+    denylist = TokenDenylist()
+    denylist.on_notification(None, 1, "revoked_tokens", f"revoked {int(time.time()) + 60}")
+    assert "revoked" in denylist
@@ -0,0 +1,79 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from src import config, events
+from src.config import TEST_DATABASE_URL
+from src.database import Base
+from src.schemas import UserSchemaPatch, UserEventSchemaOut
+from src.services import UserService
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_stream_user_events_sends_event_once(seed_db, session: AsyncSession, monkeypatch):
+    monkeypatch.setattr(events, "REPLAY_BATCH_SIZE", 1)  # Several replay batches after subscription
+    await UserService(session).patch_user(id=2, user_data=UserSchemaPatch(is_active=False))
+    subscribe = events.broadcaster.subscribe
+    get_user_events = UserService.get_user_events
+    state = {"subscribed": False}
+
+    def subscribe_and_remember():
+        state["subscribed"] = True
+        return subscribe()
+
+    async def get_user_events_with_new_ones(self, after: int, limit: int):
+        if state.pop("subscribed", False):  # Events committed right after subscription, they come both ways
+            for is_active in (True, False):
+                await UserService(session).patch_user(id=3, user_data=UserSchemaPatch(is_active=is_active))
+            for event in await get_user_events(self, after=after, limit=10):
+                events.broadcaster._on_notification(
+                    None, 0, config.USER_EVENTS_CHANNEL, UserEventSchemaOut.from_orm(event).json()
+                )
+            events.broadcaster._on_notification(None, 0, config.USER_EVENTS_CHANNEL, None)  # Closes stream
+        return await get_user_events(self, after=after, limit=limit)
+
+    monkeypatch.setattr(events.broadcaster, "subscribe", subscribe_and_remember)
+    monkeypatch.setattr(UserService, "get_user_events", get_user_events_with_new_ones)
+
+    messages = [message async for message in events.stream_user_events(session, after=0, follow=True)]
+    sent = [json.loads(message.split("\n")[1].removeprefix("data: ")) for message in messages]
+    assert [(event["user_id"], event["data"]) for event in sent] == [
+        (2, {"is_active": False}), (3, {"is_active": True}), (3, {"is_active": False})
+    ]
+
+
+async def test_user_events_are_committed_in_id_order():
+    if not TEST_DATABASE_URL.startswith("postgresql"):
+        pytest.skip("Concurrent writers of events need Postgres")
+
+    engine = create_async_engine(TEST_DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    session_maker = sessionmaker(bind=engine, expire_on_commit=False, class_=AsyncSession)
+
+    async with session_maker() as first, session_maker() as second, session_maker() as reader:
+        await UserService(first)._publish_events("update", {1: {"is_active": False}})
+
+        async def publish_and_commit_second():
+            await UserService(second)._publish_events("update", {2: {"is_active": False}})
+            await second.commit()
+
+        # Second writer tries to commit before the first one, its event would get greater id and a consumer
+        # resuming after it would never see the first event
+        second_writer = asyncio.create_task(publish_and_commit_second())
+        await asyncio.sleep(0.5)
+        assert not second_writer.done()
+        assert await UserService(reader).get_user_events(after=0, limit=10) == []
+
+        await first.commit()
+        await second_writer
+        user_events = await UserService(reader).get_user_events(after=0, limit=10)
+        assert [event.user_id for event in user_events] == [1, 2]
+        assert user_events[0].id < user_events[1].id
+
+    await engine.dispose()
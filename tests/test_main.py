@@ -1,3 +1,4 @@
+import json
 from typing import Literal
 
 import pytest
@@ -5,9 +6,11 @@ from httpx import AsyncClient
 from jose import jwt
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from src import config, notifications
 from src.config import pwd_context, AuthJWTSettings
 from src.exceptions import EmailAlreadyExistsError
-from src.models import User
+from src.models import User, RevokedToken
+from src.services import UserService
 import sqlalchemy as sa
 
 from src.utils import verify_password
@@ -135,9 +138,9 @@ async def test_create_user(client: AsyncClient, session: AsyncSession):
     assert response_user_data['email'] == user_data['email']
     assert response_user_data['is_active'] is True
 
-    result = await session.execute(sa.select(User).where(User.id == response_user_data['id']))
-    user = result.scalar_one_or_none()
-    assert pwd_context.verify(user_data['password1'], user.hashed_password)
+    result = await session.execute(sa.select(User.hashed_password).where(User.id == response_user_data['id']))
+    hashed_password = result.scalar_one()
+    assert pwd_context.verify(user_data['password1'], hashed_password)
 
 
 async def test_create_user_wrong_data(client: AsyncClient):
@@ -190,6 +193,198 @@ async def test_patch_user(
     response = await client.patch('/users/2/', json=data_to_update, headers=[auth_headers_superuser])
     assert response.status_code == 200
 
-    result = await session.execute(sa.select(User).where(User.id == response.json()["id"]))
-    user = result.scalar_one_or_none()
-    assert verify_password(data_to_update["password"], user.hashed_password)
+    result = await session.execute(sa.select(User.hashed_password).where(User.id == response.json()["id"]))
+    hashed_password = result.scalar_one()
+    assert verify_password(data_to_update["password"], hashed_password)
+
+
+async def test_delete_user(
+        client: AsyncClient,
+        auth_headers_ordinary_user: tuple[Literal["Authorization"], str],
+        session: AsyncSession
+):
+    response = await client.delete('/users/2/', headers=[auth_headers_ordinary_user])
+    assert response.status_code == 200
+    assert response.json() == {"message": "success"}
+
+    result = await session.execute(sa.select(User).where(User.id == 2))
+    user = result.scalar_one()
+    assert user.deleted_at is not None
+
+    response = await client.get('/users/me/', headers=[auth_headers_ordinary_user])
+    assert response.status_code == 401
+
+
+async def test_bulk_patch_users(
+        client: AsyncClient,
+        auth_headers_admin: tuple[Literal["Authorization"], str],
+        auth_headers_ordinary_user: tuple[Literal["Authorization"], str],
+        session: AsyncSession
+):
+    bulk_data = {"ids": [2, 3, 999], "data": {"is_active": False, "password": "bulk_password"}}
+    response = await client.patch('/users/', json=bulk_data, headers=[auth_headers_ordinary_user])
+    assert response.status_code == 403
+
+    response = await client.patch('/users/', json=bulk_data, headers=[auth_headers_admin])
+    assert response.status_code == 200
+    assert response.json() == {"updated_ids": [2, 3], "missing_ids": [999], "next_after_id": None}
+
+    result = await session.execute(sa.select(User.is_active, User.hashed_password).where(User.id.in_([2, 3])))
+    rows = result.all()
+    assert all(is_active is False for is_active, _ in rows)
+    assert rows[0].hashed_password == rows[1].hashed_password  # Password is hashed only once
+    assert verify_password("bulk_password", rows[0].hashed_password)
+
+    bulk_data = {"filter": {"email_domain": "example.com", "is_active": True}, "data": {"is_active": False}}
+    response = await client.patch('/users/', json=bulk_data, headers=[auth_headers_admin])
+    assert response.status_code == 200
+    assert response.json() == {"updated_ids": [1], "missing_ids": [], "next_after_id": None}
+
+
+async def test_bulk_patch_users_by_filter_in_batches(
+        client: AsyncClient,
+        auth_headers_admin: tuple[Literal["Authorization"], str],
+        session: AsyncSession,
+        monkeypatch
+):
+    monkeypatch.setattr(config, "BULK_PATCH_BATCH_SIZE", 2)
+    bulk_data = {"filter": {"email_domain": "example.com"}, "data": {"is_active": True}}
+    response = await client.patch('/users/', json=bulk_data, headers=[auth_headers_admin])
+    assert response.status_code == 200
+    assert response.json() == {"updated_ids": [1, 2], "missing_ids": [], "next_after_id": 2}
+
+    bulk_data["after_id"] = 2
+    response = await client.patch('/users/', json=bulk_data, headers=[auth_headers_admin])
+    assert response.json() == {"updated_ids": [3], "missing_ids": [], "next_after_id": None}
+
+    result = await session.execute(sa.select(User.is_active))
+    assert all(result.scalars())
+
+
+async def test_bulk_patch_users_wrong_data(
+        client: AsyncClient,
+        auth_headers_admin: tuple[Literal["Authorization"], str],
+        auth_headers_ordinary_user: tuple[Literal["Authorization"], str]
+):
+    response = await client.patch('/users/', json={"data": {"is_active": False}}, headers=[auth_headers_ordinary_user])
+    assert response.status_code == 422
+
+    bulk_data = {"ids": [1], "filter": {"is_active": True}, "data": {"is_active": False}}
+    response = await client.patch('/users/', json=bulk_data, headers=[auth_headers_ordinary_user])
+    assert response.status_code == 422
+
+    bulk_data = {"filter": {}, "data": {"is_active": False}}
+    response = await client.patch('/users/', json=bulk_data, headers=[auth_headers_ordinary_user])
+    assert response.status_code == 422
+
+    for data in ({}, {"password": None}):
+        response = await client.patch('/users/', json={"ids": [2], "data": data}, headers=[auth_headers_admin])
+        assert response.status_code == 422
+
+
+async def test_check_email_available(client: AsyncClient, session: AsyncSession):
+    await UserService(session).rebuild_email_filter()
+
+    response = await client.get('/users/email-available/', params={"email": "test@example.com"})
+    assert response.status_code == 200
+    assert response.json() == {"email": "test@example.com", "available": False}
+
+    response = await client.get('/users/email-available/', params={"email": "free@example.com"})
+    assert response.status_code == 200
+    assert response.json()["available"] is True
+
+    response = await client.get('/users/email-available/', params={"email": "wrong_email"})
+    assert response.status_code == 422
+
+
+async def test_rebuild_email_filter(
+        client: AsyncClient,
+        auth_headers_admin: tuple[Literal["Authorization"], str],
+        auth_headers_ordinary_user: tuple[Literal["Authorization"], str],
+        monkeypatch
+):
+    response = await client.post('/users/email-available/rebuild/', headers=[auth_headers_ordinary_user])
+    assert response.status_code == 403
+
+    sent = []
+    notify = notifications.notify
+
+    async def notify_and_remember(session, channel, payloads):
+        sent.append(channel)
+        await notify(session, channel, payloads)
+
+    monkeypatch.setattr(notifications, "notify", notify_and_remember)
+    response = await client.post('/users/email-available/rebuild/', headers=[auth_headers_admin])
+    assert response.status_code == 202
+    assert sent == [config.EMAIL_FILTER_REBUILD_CHANNEL]  # Every worker gets it, not only the one handling request
+
+
+async def test_stream_user_events(
+        client: AsyncClient,
+        auth_headers_admin: tuple[Literal["Authorization"], str],
+        auth_headers_ordinary_user: tuple[Literal["Authorization"], str]
+):
+    response = await client.delete('/users/3/', headers=[auth_headers_ordinary_user])
+    assert response.status_code == 403
+    response = await client.get('/users/events/', params={"follow": False}, headers=[auth_headers_ordinary_user])
+    assert response.status_code == 403
+
+    response = await client.patch('/users/2/', json={"is_active": False}, headers=[auth_headers_ordinary_user])
+    assert response.status_code == 200
+
+    response = await client.delete('/users/3/', headers=[auth_headers_admin])
+    assert response.status_code == 200
+
+    response = await client.get('/users/events/', params={"follow": False}, headers=[auth_headers_admin])
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    messages = [message.split("\n") for message in response.text.strip().split("\n\n")]
+    assert len(messages) == 2
+    first_event = json.loads(messages[0][1].removeprefix("data: "))
+    assert first_event["user_id"] == 2
+    assert first_event["action"] == "update"
+    assert first_event["data"] == {"is_active": False}
+    second_event = json.loads(messages[1][1].removeprefix("data: "))
+    assert second_event["user_id"] == 3
+    assert second_event["action"] == "delete"
+
+    response = await client.get(
+        '/users/events/', params={"follow": False}, headers=[auth_headers_admin, ("Last-Event-ID", str(first_event["id"]))]
+    )
+    assert response.status_code == 200
+    assert response.text.startswith(f"id: {second_event['id']}\n")
+
+
+async def test_logout(client: AsyncClient, auth_headers_ordinary_user: tuple[Literal["Authorization"], str]):
+    response = await client.post('/logout/', headers=[auth_headers_ordinary_user])
+    assert response.status_code == 200
+    assert response.json() == {"message": "success"}
+
+    response = await client.get('/users/me/', headers=[auth_headers_ordinary_user])
+    assert response.status_code == 401
+
+
+async def test_revoke_token(
+        client: AsyncClient,
+        admin_encoded_jwt_token: str,
+        auth_headers_admin: tuple[Literal["Authorization"], str],
+        auth_headers_ordinary_user: tuple[Literal["Authorization"], str],
+        session: AsyncSession
+):
+    response = await client.post(
+        '/tokens/revoke/', json={"token": admin_encoded_jwt_token}, headers=[auth_headers_ordinary_user]
+    )
+    assert response.status_code == 403
+
+    response = await client.post('/tokens/revoke/', json={"token": "test"}, headers=[auth_headers_ordinary_user])
+    assert response.status_code == 400
+
+    response = await client.post(
+        '/tokens/revoke/', json={"token": admin_encoded_jwt_token}, headers=[auth_headers_admin]
+    )
+    assert response.status_code == 200
+
+    response = await client.get('/users/me/', headers=[auth_headers_admin])
+    assert response.status_code == 401
+    result = await session.execute(sa.select(sa.func.count()).select_from(RevokedToken))
+    assert result.scalar_one() == 1
@@ -0,0 +1,121 @@
+import asyncio
+import datetime
+import json
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src import config, workers
+from src.bloom import BloomFilter
+from src.models import User, UserRow, RevokedToken
+from src.schemas import UserSchemaPatch
+from src.services import UserService, TokenService, on_user_event_notification, email_filter, rebuilt_email_filters
+from tests.conftest import PAYLOAD_DATA
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_delete_user(seed_db, session: AsyncSession):
+    await UserService(session).delete_user(id=2)
+    assert await UserService(session).get_user(id=2) is None
+    assert await UserService(session).get_user(email="test@example.com") is None
+
+
+async def test_purge_deleted_users(seed_db, session: AsyncSession):
+    await UserService(session).delete_user(id=1)
+    await UserService(session).delete_user(id=2)
+
+    assert await UserService(session).purge_deleted_users(batch_size=1) == 1
+    assert await UserService(session).purge_deleted_users(batch_size=10) == 1
+    assert await UserService(session).purge_deleted_users(batch_size=10) == 0
+
+    result = await session.execute(sa.select(User.id))
+    assert result.scalars().all() == [3]
+
+
+async def test_get_user_row(seed_db, session: AsyncSession):
+    user = await UserService(session).get_user_row(email="test@example.com")
+    assert isinstance(user, UserRow)
+    assert user.id == 2
+    assert not hasattr(user, "hashed_password")
+    assert await UserService(session).get_user_row(id=999) is None
+
+
+async def test_authenticate_user(seed_db, session: AsyncSession):
+    user = await UserService(session).authenticate_user("test@example.com", "test_password")
+    assert isinstance(user, UserRow)
+    assert user.email == "test@example.com"
+    assert await UserService(session).authenticate_user("test@example.com", "wrong_password") is None
+    assert await UserService(session).authenticate_user("missing@example.com", "test_password") is None
+
+
+async def test_user_events(seed_db, session: AsyncSession):
+    await UserService(session).patch_user(id=2, user_data=UserSchemaPatch(password="new_password"))
+    await UserService(session).delete_user(id=2)
+    await UserService(session).delete_user(id=2)  # Already deleted, no event
+
+    events = await UserService(session).get_user_events(after=0, limit=10)
+    assert [(event.user_id, event.action, event.data) for event in events] == [(2, "update", {}), (2, "delete", {})]
+    assert await UserService(session).get_user_events(after=events[0].id, limit=10) == events[1:]
+
+
+async def test_purge_user_events(seed_db, session: AsyncSession):
+    for is_active in (False, True, False):
+        await UserService(session).patch_user(id=2, user_data=UserSchemaPatch(is_active=is_active))
+    older_than = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=1)
+
+    assert await UserService(session).purge_user_events(older_than=older_than, batch_size=2) == 2
+    assert await UserService(session).purge_user_events(older_than=older_than, batch_size=2) == 1
+    assert await UserService(session).get_user_events(after=0, limit=10) == []
+
+
+async def test_purge_expired_tokens(session: AsyncSession):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for jti, expires_at in (("expired-1", now - datetime.timedelta(hours=1)),
+                            ("expired-2", now - datetime.timedelta(hours=2)),
+                            ("active", now + datetime.timedelta(hours=1))):
+        session.add(RevokedToken(jti=jti, expires_at=expires_at))
+    await session.commit()
+
+    assert await TokenService(session).purge_expired_tokens(batch_size=1) == 1
+    assert await TokenService(session).purge_expired_tokens(batch_size=10) == 1
+    result = await session.execute(sa.select(RevokedToken.jti))
+    assert result.scalars().all() == ["active"]
+
+
+async def test_email_filter_gets_users_of_other_workers(seed_db, session: AsyncSession):
+    await UserService(session).rebuild_email_filter()
+    data = {**PAYLOAD_DATA["user_2"], "email": "other-worker@example.com"}
+    session.add(User(**data))  # Created by another worker, this one only gets notification
+    await session.commit()
+    assert await UserService(session).is_email_available("other-worker@example.com")  # Stale answer before it
+
+    payload = json.dumps({"id": 1, "user_id": 4, "action": "create", "data": {"email": "other-worker@example.com"}})
+    on_user_event_notification(None, 0, "user_events", payload)
+    assert "other-worker@example.com" in email_filter
+    assert not await UserService(session).is_email_available("other-worker@example.com")
+
+
+async def test_email_filter_keeps_emails_added_during_rebuild(seed_db, session: AsyncSession):
+    new_filter = BloomFilter(capacity=100, error_rate=0.01)
+    rebuilt_email_filters.append(new_filter)  # As if rebuild was in progress
+    try:
+        payload = json.dumps({"id": 1, "user_id": 4, "action": "create", "data": {"email": "new@example.com"}})
+        on_user_event_notification(None, 0, "user_events", payload)
+    finally:
+        rebuilt_email_filters.remove(new_filter)
+    assert "new@example.com" in new_filter
+
+
+async def test_email_filter_rebuild_notification_rebuilds_filter(monkeypatch):
+    rebuilt = asyncio.Event()
+
+    async def rebuild_email_filter(self):
+        rebuilt.set()
+        return 0
+
+    monkeypatch.setattr(UserService, "rebuild_email_filter", rebuild_email_filter)
+    workers.on_email_filter_rebuild_notification(None, 0, config.EMAIL_FILTER_REBUILD_CHANNEL, "")
+    assert len(workers.email_filter_rebuild_tasks) == 1
+    await asyncio.wait_for(rebuilt.wait(), timeout=1)
@@ -0,0 +1,165 @@
+import pytest
+import pytest_asyncio
+import sqlalchemy as sa
+from fastapi_jwt_auth import AuthJWT
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+from src import config, sharding
+from src.config import TEST_DATABASE_URL, TEST_DB_SHARD_URLS
+from src.database import Base
+from src.dependencies import get_async_session
+from src.main import app
+from src.models import User
+from src.schemas import UserSchemaPatch
+from src.services import UserService
+from tests.conftest import PAYLOAD_DATA
+
+
+def test_slot_for_email():
+    slot = sharding.slot_for_email("test@example.com")
+    assert 0 <= slot < config.DB_SHARD_SLOTS_COUNT
+    assert sharding.slot_for_email("  Test@Example.com ") == slot
+
+
+def test_slot_for_id():
+    assert sharding.slot_for_id(5 * config.DB_SHARD_SLOTS_COUNT + 7) == 7
+
+
+def test_validate_slot_map():
+    sharding.validate_slot_map([slot % 3 for slot in range(config.DB_SHARD_SLOTS_COUNT)], shards_count=3)
+    with pytest.raises(ValueError):
+        sharding.validate_slot_map([0, 1], shards_count=2)
+    with pytest.raises(ValueError):
+        sharding.validate_slot_map([2] * config.DB_SHARD_SLOTS_COUNT, shards_count=2)
+
+
+@pytest_asyncio.fixture(scope="function")
+async def sharded_session(monkeypatch) -> AsyncSession:
+    if len(TEST_DB_SHARD_URLS) < 2:
+        pytest.skip("Set TEST_DB_SHARD_URLS with at least two shards")
+
+    monkeypatch.setattr(config, "DB_SHARD_URLS", TEST_DB_SHARD_URLS)
+    monkeypatch.setattr(
+        config, "DB_SHARD_SLOT_MAP", [slot % len(TEST_DB_SHARD_URLS) for slot in range(config.DB_SHARD_SLOTS_COUNT)]
+    )
+    engines = [create_async_engine(url) for url in (TEST_DATABASE_URL, *TEST_DB_SHARD_URLS)]
+    for engine in engines:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+
+    async with sharding.sharded_sessionmaker(engines[0], engines[1:])() as session:
+        for data in PAYLOAD_DATA.values():
+            session.add(User(id=sharding.new_user_id(data["email"]), **data))
+        await session.commit()
+        yield session
+
+    for engine in engines:
+        await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_sharded_user_service(sharded_session: AsyncSession):
+    users = await UserService(sharded_session).list_users()
+    assert sorted(user.email for user in users) == sorted(data["email"] for data in PAYLOAD_DATA.values())
+    assert [user.id for user in users] == sorted(user.id for user in users)
+
+    for user in users:
+        assert sharding.slot_for_id(user.id) == sharding.slot_for_email(user.email)
+        assert await UserService(sharded_session).get_user_row(id=user.id) == user
+        assert await UserService(sharded_session).get_user_row(email=user.email) == user
+
+        shard_url = config.DB_SHARD_URLS[int(sharding.shard_for_slot(sharding.slot_for_id(user.id)))]
+        engine = create_async_engine(shard_url)
+        async with engine.connect() as conn:
+            result = await conn.execute(sa.select(User.email).where(User.id == user.id))
+            assert result.scalar_one() == user.email
+        await engine.dispose()
+
+    authenticated = await UserService(sharded_session).authenticate_user("test@example.com", "test_password")
+    assert authenticated.email == "test@example.com"
+
+
+@pytest.mark.asyncio
+async def test_sharded_user_id_over_32_bits(sharded_session: AsyncSession):
+    for shard in sharding.user_shards():  # Sequence value that gives ids over 32 bits
+        await sharded_session.execute(
+            sa.text(f"SELECT setval('{sharding.USER_LOCAL_ID_SEQUENCE}', {2 ** 31 // config.DB_SHARD_SLOTS_COUNT})"),
+            bind_arguments={"shard_id": shard}
+        )
+    data = {**PAYLOAD_DATA["user_2"], "email": "big-id@example.com"}
+    sharded_session.add(User(id=sharding.new_user_id(data["email"]), **data))
+    await sharded_session.commit()
+
+    user = await UserService(sharded_session).get_user_row(email="big-id@example.com")
+    assert user.id > 2 ** 31
+    assert await UserService(sharded_session).get_user_row(id=user.id) == user
+
+
+@pytest.mark.asyncio
+async def test_sharded_user_events_are_committed_after_changes(sharded_session: AsyncSession):
+    user = await UserService(sharded_session).get_user_row(email="test@example.com")
+    commit = sharded_session.commit
+    events_seen_before_commit = []
+
+    async def read_events_and_commit():
+        events_seen_before_commit.extend(await UserService(sharded_session).get_user_events(after=0, limit=10))
+        await commit()
+
+    sharded_session.commit = read_events_and_commit
+    await UserService(sharded_session).patch_user(id=user.id, user_data=UserSchemaPatch(is_active=False))
+    assert events_seen_before_commit == []  # Nobody gets an event before its change can be read
+
+    async def fail_commit():
+        raise ConnectionError("Shard is down")
+
+    sharded_session.commit = fail_commit
+    with pytest.raises(ConnectionError):
+        await UserService(sharded_session).patch_user(id=user.id, user_data=UserSchemaPatch(is_active=True))
+    del sharded_session.commit
+    await sharded_session.rollback()
+
+    # Change wasn't made and its event is dropped with it
+    assert not (await UserService(sharded_session).get_user_row(id=user.id)).is_active
+    events = await UserService(sharded_session).get_user_events(after=0, limit=10)
+    assert [(event.user_id, event.action, event.data) for event in events] == [(user.id, "update", {"is_active": False})]
+
+
+@pytest_asyncio.fixture(scope="function")
+async def sharded_client(sharded_session: AsyncSession) -> AsyncClient:
+    async def _override_get_async_session():
+        yield sharded_session
+
+    app.dependency_overrides[get_async_session] = _override_get_async_session
+    async with AsyncClient(app=app, base_url="http://localhost:8000") as ac:
+        yield ac
+    app.dependency_overrides.pop(get_async_session)
+
+
+@pytest.mark.asyncio
+async def test_sharded_logout_and_bulk_patch(sharded_client: AsyncClient, monkeypatch):
+    token = AuthJWT().create_access_token(subject=PAYLOAD_DATA["user_1"]["email"], algorithm="HS256")
+    auth_headers = ('Authorization', f'Bearer {token}')
+
+    response = await sharded_client.get('/users/', headers=[auth_headers])
+    ids = sorted(user["id"] for user in response.json() if user["email"] != PAYLOAD_DATA["user_1"]["email"])
+    response = await sharded_client.patch(
+        '/users/', json={"ids": ids, "data": {"is_active": False}}, headers=[auth_headers]
+    )
+    assert response.status_code == 200
+    assert sorted(response.json()["updated_ids"]) == ids
+
+    monkeypatch.setattr(config, "BULK_PATCH_BATCH_SIZE", 1)  # Every batch merges ids of all shards
+    bulk_data = {"filter": {"is_active": False}, "after_id": 0, "data": {"is_active": True}}
+    updated_ids = []
+    while bulk_data["after_id"] is not None:
+        response = await sharded_client.patch('/users/', json=bulk_data, headers=[auth_headers])
+        updated_ids += response.json()["updated_ids"]
+        bulk_data["after_id"] = response.json()["next_after_id"]
+    assert updated_ids == ids
+
+    response = await sharded_client.post('/logout/', headers=[auth_headers])
+    assert response.status_code == 200
+    response = await sharded_client.get('/users/me/', headers=[auth_headers])
+    assert response.status_code == 401
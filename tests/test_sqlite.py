@@ -0,0 +1,88 @@
+import asyncio
+import datetime
+import time
+
+import pytest
+import pytest_asyncio
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+from src.database import Base, create_sqlite_engines, routing_sessionmaker
+from src.denylist import denylist
+from src.models import User, RevokedToken
+from src.schemas import UserSchemaPatch
+from src.services import UserService, TokenService
+from tests.conftest import PAYLOAD_DATA
+
+pytest.importorskip("aiosqlite")
+pytestmark = pytest.mark.asyncio
+
+
+@pytest_asyncio.fixture(scope="function")
+async def sqlite_session_maker(tmp_path) -> sessionmaker:
+    writer_engine, reader_engine = create_sqlite_engines(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+    async with writer_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    session_maker = routing_sessionmaker(writer_engine, reader_engine)
+    async with session_maker() as session:
+        for data in PAYLOAD_DATA.values():
+            session.add(User(**data))
+        await session.commit()
+    yield session_maker
+
+    await writer_engine.dispose()
+    await reader_engine.dispose()
+
+
+async def test_sqlite_pragmas(sqlite_session_maker: sessionmaker):
+    async with sqlite_session_maker() as session:
+        result = await session.execute(sa.text("PRAGMA journal_mode"))
+        assert result.scalar_one() == "wal"
+
+
+async def test_sqlite_concurrent_writes(sqlite_session_maker: sessionmaker):
+    async def patch_user(is_active: bool):
+        async with sqlite_session_maker() as session:
+            return await UserService(session).patch_user(id=2, user_data=UserSchemaPatch(is_active=is_active))
+
+    users = await asyncio.gather(*(patch_user(i % 2 == 0) for i in range(20)))
+    assert all(user.id == 2 for user in users)
+
+    async with sqlite_session_maker() as session:
+        assert [event.action for event in await UserService(session).get_user_events(after=0, limit=100)] == \
+               ["update"] * 20
+
+
+async def test_sqlite_user_service(sqlite_session_maker: sessionmaker):
+    async with sqlite_session_maker() as session:
+        updated_ids = await UserService(session).bulk_patch_users(UserSchemaPatch(is_active=False), ids=[1, 2, 999])
+        assert sorted(updated_ids) == [1, 2]
+
+        await UserService(session).delete_user(id=3)
+        assert await UserService(session).get_user_row(id=3) is None
+        assert await UserService(session).purge_deleted_users(batch_size=10) == 1
+
+        expires_at = int(time.time()) + 60
+        await TokenService(session).revoke_token(jti="sqlite-test-jti", expires_at=expires_at)
+        await TokenService(session).revoke_token(jti="sqlite-test-jti", expires_at=expires_at)  # Conflict is ignored
+        assert "sqlite-test-jti" in denylist
+        result = await session.execute(sa.select(sa.func.count()).select_from(RevokedToken))
+        assert result.scalar_one() == 1
+
+
+async def test_sqlite_datetimes_are_utc(sqlite_session_maker: sessionmaker):
+    utc = datetime.timezone.utc
+    expires_at = datetime.datetime(2100, 1, 1, 15, tzinfo=datetime.timezone(datetime.timedelta(hours=3)))
+    async with sqlite_session_maker() as session:
+        session.add(RevokedToken(jti="utc-test-jti", expires_at=expires_at))
+        await session.commit()
+
+        [token] = await TokenService(session).get_revoked_tokens()
+        assert token.expires_at == expires_at
+        assert token.expires_at.tzinfo == utc and token.revoked_at.tzinfo == utc
+        assert (await UserService(session).get_user_row(id=1)).created_at.tzinfo == utc
+
+        # Stored in UTC, so comparisons with time in other zones are right
+        query = sa.select(RevokedToken.jti).where(RevokedToken.expires_at > datetime.datetime(2100, 1, 1, 13, tzinfo=utc))
+        assert (await session.execute(query)).first() is None